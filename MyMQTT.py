@@ -0,0 +1,73 @@
+import json
+import paho.mqtt.client as PahoMQTT
+
+
+class MyMQTT:
+    def __init__(self, clientID, broker, port, notifier):
+        self.broker = broker
+        self.port = port
+        self.notifier = notifier
+        self.clientID = clientID
+        self._topic = ""
+        self._isSubscriber = False
+        # every subscribed topic, subscribed again on reconnection as the session is not kept by the broker
+        self._topics = []
+        # create an instance of paho.mqtt.client
+        self._paho_mqtt = PahoMQTT.Client(clientID, True)
+        # register the callback
+        self._paho_mqtt.on_connect = self.myOnConnect
+        self._paho_mqtt.on_message = self.myOnMessageReceived
+        self._paho_mqtt.on_disconnect = self.myOnDisconnect
+
+    def myOnConnect(self, paho_mqtt, userdata, flags, rc):
+        print("Connected to %s with result code: %d" % (self.broker, rc))
+        if rc == 0:
+            for topic in self._topics:
+                self._paho_mqtt.subscribe(topic, 2)
+            # lets the notifier react to the (re)connections, if it wants to
+            if hasattr(self.notifier, "connected"):
+                self.notifier.connected()
+
+    def myOnDisconnect(self, paho_mqtt, userdata, rc):
+        print("Disconnected from %s with result code: %d" % (self.broker, rc))
+        if hasattr(self.notifier, "disconnected"):
+            self.notifier.disconnected()
+
+    def myOnMessageReceived(self, paho_mqtt, userdata, msg):
+        # A new message is received
+        self.notifier.notify(msg.topic, msg.payload)
+
+    def myPublish(self, topic, msg):
+        # publish a message with a certain topic
+        self._paho_mqtt.publish(topic, json.dumps(msg), 2)
+
+    def mySubscribe(self, topic):
+
+        # subscribe for a topic
+        self._paho_mqtt.subscribe(topic, 2)
+        # just to remember that it works also as a subscriber
+        self._isSubscriber = True
+        self._topic = topic
+        if topic not in self._topics:
+            self._topics.append(topic)
+        print("subscribed to %s" % (topic))
+
+    def start(self):
+        # manage connection to broker
+        self._paho_mqtt.connect(self.broker, self.port)
+        self._paho_mqtt.loop_start()
+
+    def unsubscribe(self):
+        if (self._isSubscriber):
+            # remember to unsuscribe if it is working also as subscriber
+            for topic in self._topics:
+                self._paho_mqtt.unsubscribe(topic)
+
+    def stop(self):
+        if (self._isSubscriber):
+            # remember to unsuscribe if it is working also as subscriber
+            for topic in self._topics:
+                self._paho_mqtt.unsubscribe(topic)
+
+        self._paho_mqtt.loop_stop()
+        self._paho_mqtt.disconnect()
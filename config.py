@@ -5,14 +5,44 @@ from dotenv import load_dotenv
 load_dotenv()
 
 class Config:
+    STORAGE_ENGINE = os.getenv("STORAGE_ENGINE", "mongo")  # mongo, memory or sqlite
+    SQLITE_PATH = os.getenv("SQLITE_PATH", "catalog.db")
     MONGO_URL = os.getenv("MONGO_URL")
+    MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 20000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 0))  # 0 means no limit
     DB = os.getenv("DB")
     GENERAL_COLLECTION = os.getenv("GENERAL_COLLECTION")
     PLANTS_COLLECTION = os.getenv("PLANTS_COLLECTION")
     DEVICES_COLLECTION = os.getenv("DEVICES_COLLECTION")
     USERS_COLLECTION = os.getenv("USERS_COLLECTION")
+    TOMBSTONES_COLLECTION = os.getenv("TOMBSTONES_COLLECTION", "tombstones")
     CLEANUP_THRESHOLD = int(os.getenv("CLEANUP_THRESHOLD"))
     CLEANUP_INTERVAL = int(os.getenv("CLEANUP_INTERVAL"))
+    LEASES_COLLECTION = os.getenv("LEASES_COLLECTION", "leases")
+    CLEANUP_LEASE_TTL = int(os.getenv("CLEANUP_LEASE_TTL", 30))  # seconds
+    CLEANUP_LEASE_RENEW = int(os.getenv("CLEANUP_LEASE_RENEW", 10))  # seconds, below CLEANUP_LEASE_TTL
+    TOMBSTONES_RETENTION = int(os.getenv("TOMBSTONES_RETENTION", 1440))  # minutes
+    STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 500))  # documents per database round trip
+    REGISTRY_MQTT_CLIENT_ID = os.getenv("REGISTRY_MQTT_CLIENT_ID", "smm_registry")
+    CHANGES_TOPIC = os.getenv("CHANGES_TOPIC", "catalog/changes")  # under the main topic
+    # While the change events are not connected, the read caches are dropped this often, in seconds
+    CACHE_TTL = int(os.getenv("CACHE_TTL", 5))
+    STATUS_FLUSH_INTERVAL_MS = int(os.getenv("STATUS_FLUSH_INTERVAL_MS", 50))
+    STATUS_FLUSH_MAX_ENTRIES = int(os.getenv("STATUS_FLUSH_MAX_ENTRIES", 500))
+    SERVER_THREAD_POOL = int(os.getenv("SERVER_THREAD_POOL", 30))
+    WATCH_MAX_CLIENTS = int(os.getenv("WATCH_MAX_CLIENTS", 10))  # below SERVER_THREAD_POOL
+    WATCH_TIMEOUT = int(os.getenv("WATCH_TIMEOUT", 30))  # seconds, longest poll and keep alive interval
+    SSE_MAX_DURATION = int(os.getenv("SSE_MAX_DURATION", 300))  # seconds, the clients reconnect after it
+    # Presence and status messages of the device connectors, under the main topic
+    PRESENCE_INGESTION = os.getenv("PRESENCE_INGESTION", "false").lower() in ["true", "1"]
+    PRESENCE_TOPIC = os.getenv("PRESENCE_TOPIC", "catalog/presence")
+    STATUS_TOPIC = os.getenv("STATUS_TOPIC", "catalog/status")
+    JSON_SERIALIZER = os.getenv("JSON_SERIALIZER", "orjson")  # orjson or json
+    COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))  # bytes
+    COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 5))
 
 
     
\ No newline at end of file
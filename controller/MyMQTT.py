@@ -10,6 +10,8 @@ class MyMQTT:
         self.clientID = clientID
         self._topic = ""
         self._isSubscriber = False
+        # every subscribed topic, subscribed again on reconnection as the session is not kept by the broker
+        self._topics = []
         # create an instance of paho.mqtt.client
         self._paho_mqtt = PahoMQTT.Client(clientID, True)
         # register the callback
@@ -18,6 +20,9 @@ class MyMQTT:
 
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
         print("Connected to %s with result code: %d" % (self.broker, rc))
+        if rc == 0:
+            for topic in self._topics:
+                self._paho_mqtt.subscribe(topic, 2)
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
         # A new message is received
@@ -34,6 +39,8 @@ class MyMQTT:
         # just to remember that it works also as a subscriber
         self._isSubscriber = True
         self._topic = topic
+        if topic not in self._topics:
+            self._topics.append(topic)
         print("subscribed to %s" % (topic))
 
     def start(self):
@@ -44,12 +51,14 @@ class MyMQTT:
     def unsubscribe(self):
         if (self._isSubscriber):
             # remember to unsuscribe if it is working also as subscriber
-            self._paho_mqtt.unsubscribe(self._topic)
+            for topic in self._topics:
+                self._paho_mqtt.unsubscribe(topic)
 
     def stop(self):
         if (self._isSubscriber):
             # remember to unsuscribe if it is working also as subscriber
-            self._paho_mqtt.unsubscribe(self._topic)
+            for topic in self._topics:
+                self._paho_mqtt.unsubscribe(topic)
 
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -0,0 +1,64 @@
+'''State of the actuators as the controller commanded them, to publish a command only on a real transition'''
+import threading
+import time
+
+
+class ActuatorStates:
+    """
+    Tracks for each actuator the last command sent, when, and the last status acknowledged by its device connector.
+    A command is sent only if it differs from the commanded state, and not before min_dwell seconds
+    since the previous one. A command not acknowledged within ack_timeout seconds is sent again.
+    A different status, reported by the device connector or read from the catalog, may predate the last command:
+    it only overrides the commanded state once ack_timeout passed since that command.
+    """
+    def __init__(self, min_dwell: float, ack_timeout: float):
+        self.min_dwell = min_dwell
+        self.ack_timeout = ack_timeout
+        # device id -> {"commanded", "commandedAt", "acknowledged"}
+        self.states = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.suppressed = 0
+
+    def should_send(self, device_id: int, command: str, catalog_status: str = None) -> bool:
+        """Whether to publish command to the actuator, recording it as commanded if so"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.states.setdefault(device_id, {"commanded": None, "commandedAt": None, "acknowledged": None})
+            if catalog_status:
+                self._acknowledge(state, catalog_status, now)
+
+            if state["commanded"] == command:
+                # Sent again only if the device connector never confirmed it
+                send = state["acknowledged"] != command and now - state["commandedAt"] >= self.ack_timeout
+            elif state["commanded"] is None:
+                send = state["acknowledged"] != command
+            else:
+                # A transition, unless the previous one is too recent
+                send = now - state["commandedAt"] >= self.min_dwell
+
+            if send:
+                state["commanded"], state["commandedAt"] = command, now
+                self.sent += 1
+            else:
+                self.suppressed += 1
+            return send
+
+    def acknowledge(self, device_id: int, status: str):
+        """Records a status reported by the device connector"""
+        with self.lock:
+            state = self.states.setdefault(device_id, {"commanded": None, "commandedAt": None, "acknowledged": None})
+            self._acknowledge(state, status, time.monotonic())
+
+    def _acknowledge(self, state: dict, status: str, now: float):
+        if status == state["commanded"]:
+            state["acknowledged"] = status
+            return
+        # A different status is a change made elsewhere, e.g. from the bot, unless it predates the last command
+        if state["commanded"] is None or now - state["commandedAt"] >= self.ack_timeout:
+            state["commanded"], state["commandedAt"] = None, None
+            state["acknowledged"] = status
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"sent": self.sent, "suppressed": self.suppressed}
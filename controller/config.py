@@ -12,6 +12,19 @@ class Config:
     MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID")
     SOIL_MOSTURE_MIN = int(os.getenv("SOIL_MOSTURE_MIN"))
     SOIL_MOSTURE_SUITABLE = int(os.getenv("SOIL_MOSTURE_SUITABLE"))
+    # Seconds between the delta reloads of the plants' devices, also run on the catalog change events
+    TOPOLOGY_TTL = int(os.getenv("TOPOLOGY_TTL", 300))
+    CHANGES_TOPIC = os.getenv("CHANGES_TOPIC", "catalog/changes")  # under the main topic
+    # Threads handling the sensor messages, and the messages each one queues before dropping the oldest
+    WORKERS = int(os.getenv("WORKERS", 4))
+    WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 100))
+    # drop-oldest, or coalesce to also replace a plant's pending reading with its newer one
+    OVERLOAD_POLICY = os.getenv("OVERLOAD_POLICY", "coalesce")
+    STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", 60))  # second
+    # Seconds between two commands to an actuator, and before an unacknowledged command is sent again
+    MIN_DWELL = int(os.getenv("MIN_DWELL", 10))
+    ACK_TIMEOUT = int(os.getenv("ACK_TIMEOUT", 30))
+    STATUS_TOPIC = os.getenv("STATUS_TOPIC", "catalog/status")  # under the main topic
 
 
 
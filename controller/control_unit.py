@@ -1,9 +1,13 @@
+import copy
 import json
 import requests
 import time
 from typing import List
 from config import Config
 from MyMQTT import MyMQTT
+from topology import Topology
+from workers import WorkerPool
+from actuators import ActuatorStates
 
 class Controller:
     """
@@ -35,8 +39,17 @@ class Controller:
         }
         
         print("Initiating the controller...")
-        self.set_broker()
-        self.set_main_topic()
+        self.bootstrap()
+        # Actuators and sensors of each plant, kept locally so that the readings are handled without catalog requests
+        self.topology = Topology(self.config.CATALOG_URL, self.config.TOPOLOGY_TTL)
+        self.topology.start()
+        # The readings are handled by the workers, so that a slow one does not hold up paho's network thread
+        self.workers = WorkerPool(
+            self.process_reading, self.config.WORKERS, self.config.WORKER_QUEUE_SIZE, self.config.OVERLOAD_POLICY
+        )
+        self.workers.start()
+        # Commanded and acknowledged state of each actuator, the catalog's status lags behind the commands
+        self.actuators = ActuatorStates(self.config.MIN_DWELL, self.config.ACK_TIMEOUT)
         self.initiate_mqtt()
 
 
@@ -51,11 +64,15 @@ class Controller:
         self.mqtt_client.start()
         time.sleep(0.5)
         self.mqtt_client.mySubscribe(f"{self.main_topic}/sensors/#")
+        self.mqtt_client.mySubscribe(f"{self.main_topic}/{self.config.CHANGES_TOPIC}")
+        # Statuses published by the device connectors reporting presence over MQTT
+        self.mqtt_client.mySubscribe(f"{self.main_topic}/{self.config.STATUS_TOPIC}/+")
 
 
-    def set_broker(self, retries=3, delay=5):
+    def bootstrap(self, retries=3, delay=5):
         """
-        Retrieve broker connection details from the catalog service.
+        Retrieve broker connection details and the main topic from the catalog
+        service with a single bootstrap request.
         Implements retry logic in case of connection failures.
         
         Args:
@@ -64,12 +81,15 @@ class Controller:
         """
         for attempt in range(retries):
             try:
-                req_b = requests.get(self.config.CATALOG_URL + "/broker")
+                # Broker and main topic come together in a single request
+                req_b = requests.get(self.config.CATALOG_URL + "/bootstrap")
                 req_b.raise_for_status()  # Raise an exception for HTTP errors
                 req_data = req_b.json()
-                broker_info = req_data.get("content", {})
+                bootstrap = req_data.get("content", {})
+                broker_info = bootstrap.get("broker") or {}
                 self.broker, self.port = broker_info.get("IP"), int(broker_info.get("port", 1883))
-                print("Broker's info received")
+                self.main_topic = bootstrap.get("mainTopic")
+                print("Broker's info and main topic received")
                 return {"success": True}
                 # Exit the function if successful
 
@@ -82,29 +102,53 @@ class Controller:
                     print("All attempts to get the broker's information have failed.")
                     raise ConnectionError("All attempts to get the broker's information have failed.")
 
-
-    def set_main_topic(self):
-        req = requests.get(self.config.CATALOG_URL + "/main_topic")
-        self.main_topic = req.json().get("content", {})
-
     
 
     def notify(self, topic, payload):
         """
-        MQTT callback function that processes incoming sensor messages.
-        Parses SenML formatted messages and routes soil moisture readings
-        to the appropriate handler.
+        MQTT callback function that queues incoming sensor messages for the workers.
+        The messages of a plant are handled in order, by the same worker.
         
         Args:
             topic: MQTT topic the message was received on
             payload: Message content in SenML format
         """
+        if topic == f"{self.main_topic}/{self.config.CHANGES_TOPIC}":
+            self.topology.on_change(payload)
+            return
+        if topic.startswith(f"{self.main_topic}/{self.config.STATUS_TOPIC}/"):
+            self.handle_status(topic, payload)
+            return
+        # Topic format: "greenhouse/sensors/101/soil_moisture"
+        levels = topic.split("/")
+        plant_key = levels[2] if len(levels) > 2 else topic
+        self.workers.submit(plant_key, (topic, payload))
+
+
+    def handle_status(self, topic, payload):
+        """Records the status reported for an actuator, on {mainTopic}/catalog/status/{deviceId}"""
+        try:
+            device_id = int(topic.rsplit("/", 1)[1])
+            self.actuators.acknowledge(device_id, json.loads(payload)["status"])
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Unrecognized status received on {topic}: {e}")
+
+
+    def process_reading(self, message):
+        """
+        Parses a SenML formatted message and routes soil moisture readings
+        to the appropriate handler. Runs on a worker thread.
+        
+        Args:
+            message: (topic, payload) tuple as received over MQTT
+        """
+        topic, payload = message
         try:
             msg = json.loads(payload)
             # Part of the message related to the event happened
             event = msg["e"][0]
         except Exception as e:
-            self.logger.warning(f"Unrecognized payload received over mqtt: {str(e)}.")
+            print(f"Unrecognized payload received over mqtt: {str(e)}.")
             return
         
         print(f"{topic} measured a {event['n']} of {event['v']} {event['u']} at time {event['t']}")
@@ -128,18 +172,12 @@ class Controller:
             plant_id = sensor_topic.split("/")[2]
             
             # Find the actuator (water pump) associated with this plant
-            response = requests.get(f"{self.config.CATALOG_URL}/devices")
-            devices = response.json().get("content", [])
-            actuator = next(
-                (device for device in devices if 
-                 device["deviceLocation"]["plantId"] == int(plant_id) 
-                 and 
-                 device["deviceType"] == "actuator"), 
-                {}
-                )
+            actuator = self.topology.actuator(int(plant_id))
             
             if not actuator:
                 print(f"Actuator for plant {plant_id} not found")
+                # The plant may have been registered after the last reload
+                self.topology.request_refresh()
                 return
 
             if actuator["deviceStatus"] == "DISABLE":
@@ -154,22 +192,22 @@ class Controller:
             else:
                 print(f"Soil moisture is optimal for plant{plant_id}")
 
-        except requests.RequestException as e:
+        except (IndexError, ValueError) as e:
             print(f"Error handling moisture reading: {e}")
 
 
     def send_water_command(self, actuator, command):
         """
         Send watering commands to an actuator via MQTT.
-        Checks current actuator state to avoid sending redundant commands.
+        Checks the commanded actuator state to avoid sending redundant commands.
         
         Args:
             actuator: Dictionary containing actuator details
             command: Either "POUR_WATER" or "STOP_WATER"
         """
         print(f"Actuator: {actuator}")
-        if actuator.get("deviceStatus") == command:
-            print(f"Actuator for plant {actuator.get('deviceLocation', {}).get('plantId', '')} is already in the desired state")
+        if not self.actuators.should_send(actuator.get("deviceId"), command, actuator.get("deviceStatus")):
+            print(f"Actuator for plant {actuator.get('deviceLocation', {}).get('plantId', '')} is already in the desired state or was commanded too recently")
             return
         
         try:
@@ -180,7 +218,8 @@ class Controller:
             )
             
             # Prepare and send SenML formatted command
-            msg = self.msg.copy()
+            # Deep copy, the workers send commands concurrently and must not share the event dict
+            msg = copy.deepcopy(self.msg)
             msg["bn"] = topic
             msg["e"][0]["t"] = str(time.time())
             msg["e"][0]["v"] = command
@@ -192,15 +231,22 @@ class Controller:
             print(f"Error sending water command: {e}")
 
     def stop(self):
-        """Stop the MQTT client"""
+        """Stop the MQTT client, the workers and the topology reloads"""
         if self.mqtt_client:
             self.mqtt_client.stop()
+        self.workers.stop()
+        self.topology.stop()
 
 
 
 if __name__ == "__main__":
     config = Config()
     controller = Controller(config)
+    counter = 0
     while True:
-        time.sleep(1)   
+        time.sleep(1)
+        counter += 1
+        # Queue depth and handling latency of the workers
+        if counter % config.STATS_INTERVAL == 0:
+            print(f"Workers: {controller.workers.stats()}, commands: {controller.actuators.stats()}")
     controller.stop()
@@ -0,0 +1,127 @@
+'''Local copy of the plants' actuators and sensors, so that the watering decisions need no catalog request'''
+import json
+import threading
+import requests
+
+# Older than any tombstone, so the first load returns all the devices
+EPOCH_CURSOR = "1970-01-01 00:00:00"
+
+
+class Topology:
+    """
+    Map from plant id to its actuators and sensors, loaded from the catalog at start.
+    It is kept up to date with delta queries (?since=) from the cursor of the previous one: every ttl seconds,
+    and as soon as the catalog announces devices added, changed or deleted.
+    Status change events carry the new statuses and are applied without any request.
+    """
+    # Only what the watering decision and the command need
+    FIELDS = "deviceId,deviceType,deviceStatus,deviceLocation.plantId,servicesDetails"
+
+    def __init__(self, catalog_url: str, ttl: int):
+        self.catalog_url = catalog_url
+        self.ttl = ttl
+        # device id -> device, and plant id -> {"actuators": [...], "sensors": [...]} built from them
+        self.devices = {}
+        self.plants = {}
+        self.cursor = EPOCH_CURSOR
+        self.lock = threading.Lock()
+        self.refresh_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Loads the map, then keeps it up to date in the background"""
+        self.load()
+        self.thread = threading.Thread(target=self._run, name="topology", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.refresh_requested.set()
+        if self.thread:
+            self.thread.join()
+
+    def load(self) -> bool:
+        """Applies the device changes since the last load, returns False if the request failed and the old copy is kept"""
+        try:
+            response = requests.get(
+                f"{self.catalog_url}/devices", params={"since": self.cursor, "fields": self.FIELDS}, timeout=10
+            )
+            response.raise_for_status()
+            delta = response.json().get("content", {})
+        except (requests.RequestException, json.JSONDecodeError) as e:
+            print(f"Failed to load the devices of the plants: {e}")
+            return False
+
+        with self.lock:
+            # full is set when the deletions since the cursor are no longer known, the copy is replaced
+            devices = {} if delta.get("full") else dict(self.devices)
+            for device_id in delta.get("deleted", []):
+                devices.pop(device_id, None)
+            for device in delta.get("changes", []):
+                devices[device["deviceId"]] = device
+            self._index(devices)
+            self.cursor = delta.get("cursor", self.cursor)
+        if delta.get("changes") or delta.get("deleted"):
+            print(f"Loaded {len(delta.get('changes', []))} changed and {len(delta.get('deleted', []))} deleted devices")
+        return True
+
+    def _index(self, devices: dict):
+        plants = {}
+        for device in devices.values():
+            plant_id = device.get("deviceLocation", {}).get("plantId")
+            if plant_id is None:
+                continue
+            kind = "actuators" if device.get("deviceType") == "actuator" else "sensors"
+            plants.setdefault(int(plant_id), {"actuators": [], "sensors": []})[kind].append(device)
+        # Replaced as a whole, the readers never see a partial map
+        self.devices, self.plants = devices, plants
+
+    def actuator(self, plant_id: int) -> dict:
+        """The plant's first actuator, or an empty dict if it has none"""
+        return next(iter(self.plants.get(plant_id, {}).get("actuators", [])), {})
+
+    def sensors(self, plant_id: int) -> list:
+        return self.plants.get(plant_id, {}).get("sensors", [])
+
+    def request_refresh(self):
+        """Asks the background thread for a delta query, the requests arriving meanwhile are served by the same one"""
+        self.refresh_requested.set()
+
+    def on_change(self, payload):
+        """Handles a change event of the catalog, only the device changes affect the map"""
+        try:
+            event = json.loads(payload)
+        except (json.JSONDecodeError, TypeError) as e:
+            print(f"Unrecognized change event: {e}")
+            return
+        # Presence and touch events only refresh fields the map does not hold
+        if event.get("entity") != "devices" or event.get("operation") in ("presence", "touch"):
+            return
+        if event.get("operation") == "status":
+            self._apply_statuses(event.get("statuses", {}))
+        elif event.get("operation") == "delete":
+            with self.lock:
+                devices = dict(self.devices)
+                for device_id in event.get("ids", []):
+                    devices.pop(device_id, None)
+                self._index(devices)
+        else:
+            self.request_refresh()
+
+    def _apply_statuses(self, statuses: dict):
+        with self.lock:
+            devices = dict(self.devices)
+            for device_id, status in statuses.items():
+                # The JSON keys are strings
+                device = devices.get(int(device_id))
+                if device is not None:
+                    devices[device["deviceId"]] = {**device, "deviceStatus": status}
+            self._index(devices)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.refresh_requested.wait(self.ttl)
+            self.refresh_requested.clear()
+            if not self.stopped.is_set():
+                self.load()
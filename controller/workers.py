@@ -0,0 +1,118 @@
+'''Pool of worker threads handling the MQTT messages outside of the network thread'''
+import threading
+import time
+from collections import deque
+
+POLICIES = ("drop-oldest", "coalesce")
+
+
+class Shard:
+    """Queue of one worker, its entries are [key, item, enqueued_at]"""
+    def __init__(self):
+        self.queue = deque()
+        # key -> its pending entry, with the coalesce policy
+        self.pending = {}
+        self.condition = threading.Condition()
+
+
+class WorkerPool:
+    """
+    Runs handler(item) on a fixed number of worker threads.
+    Items with the same key always go to the same worker, so they are handled in the order they arrived.
+    Each worker queues up to max_pending items. When its queue is full the oldest one is dropped,
+    and with the coalesce policy a new item also replaces the pending one with the same key.
+    """
+    def __init__(self, handler, workers: int, max_pending: int, policy: str = "coalesce"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overload policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.handler = handler
+        self.max_pending = max_pending
+        self.policy = policy
+        self.shards = [Shard() for _ in range(workers)]
+        self.threads = []
+        self.stopped = False
+        self.stats_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        # Seconds from the arrival of an item to the end of its handling
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        for index, shard in enumerate(self.shards):
+            thread = threading.Thread(target=self._run, args=(shard,), name=f"worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Lets the workers finish the queued items and waits for them"""
+        self.stopped = True
+        for shard in self.shards:
+            with shard.condition:
+                shard.condition.notify()
+        for thread in self.threads:
+            thread.join()
+
+    def submit(self, key, item):
+        shard = self.shards[hash(key) % len(self.shards)]
+        with shard.condition:
+            entry = shard.pending.get(key)
+            if entry is not None:
+                # The newer item takes the place of the pending one, keeping its turn
+                entry[1] = item
+                with self.stats_lock:
+                    self.coalesced += 1
+                return
+            if len(shard.queue) >= self.max_pending:
+                oldest = shard.queue.popleft()
+                if shard.pending.get(oldest[0]) is oldest:
+                    del shard.pending[oldest[0]]
+                with self.stats_lock:
+                    self.dropped += 1
+            entry = [key, item, time.perf_counter()]
+            shard.queue.append(entry)
+            if self.policy == "coalesce":
+                shard.pending[key] = entry
+            shard.condition.notify()
+
+    def depth(self) -> int:
+        return sum(len(shard.queue) for shard in self.shards)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                "depth": self.depth(),
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "latencyAvgMs": self.latency_total / self.processed * 1000 if self.processed else 0.0,
+                "latencyMaxMs": self.latency_max * 1000,
+            }
+
+    def _run(self, shard: Shard):
+        while True:
+            with shard.condition:
+                shard.condition.wait_for(lambda: shard.queue or self.stopped)
+                if not shard.queue:
+                    return
+                entry = shard.queue.popleft()
+                # Unpacked under the lock, as a coalesced item may replace it until then
+                key, item, enqueued_at = entry
+                if shard.pending.get(key) is entry:
+                    del shard.pending[key]
+
+            failed = False
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"Failed to handle the message of {key}: {e}")
+                failed = True
+            latency = time.perf_counter() - enqueued_at
+            with self.stats_lock:
+                self.processed += 1
+                self.failed += int(failed)
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
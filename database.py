@@ -0,0 +1,167 @@
+'''
+Shared database of the registry: the MongoDB client, with metrics on its commands and connection pool,
+or one of the memory and SQLite engines chosen by STORAGE_ENGINE
+'''
+import threading
+import time
+from pymongo import MongoClient, monitoring
+from config import Config
+from storage import MemoryDatabase, SQLiteDatabase
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Records the count, errors and latency of every database command, by command name"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def _record(self, event, failed: bool):
+        duration_ms = event.duration_micros / 1000
+        with self.lock:
+            stats = self.commands.setdefault(
+                event.command_name, {"count": 0, "errors": 0, "totalMs": 0.0, "maxMs": 0.0}
+            )
+            stats["count"] += 1
+            stats["errors"] += int(failed)
+            stats["totalMs"] += duration_ms
+            stats["maxMs"] = max(stats["maxMs"], duration_ms)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.commands.items()}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Tracks the open and in-use connections and how long the threads wait to check one out"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Check outs start and end on the requesting thread
+        self.local = threading.local()
+        self.open_connections = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_wait_total_ms = 0.0
+        self.checkout_wait_max_ms = 0.0
+        self.pool_clears = 0
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        wait_ms = (time.perf_counter() - getattr(self.local, "started", time.perf_counter())) * 1000
+        with self.lock:
+            self.checkouts += 1
+            self.checkout_wait_total_ms += wait_ms
+            self.checkout_wait_max_ms = max(self.checkout_wait_max_ms, wait_ms)
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open_connections -= 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pool_clears += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "openConnections": self.open_connections,
+                "inUse": self.in_use,
+                "maxInUse": self.max_in_use,
+                "checkouts": self.checkouts,
+                "checkoutFailures": self.checkout_failures,
+                "checkoutWaitTotalMs": self.checkout_wait_total_ms,
+                "checkoutWaitMaxMs": self.checkout_wait_max_ms,
+                "poolClears": self.pool_clears,
+            }
+
+
+command_metrics = CommandMetrics()
+pool_metrics = PoolMetrics()
+
+_client = None
+_client_lock = threading.Lock()
+# Database of the memory or SQLite engine
+_storage = None
+
+
+def get_client() -> MongoClient:
+    """Returns the process wide MongoClient, creating it with the configured pool settings on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(
+                Config.MONGO_URL,
+                maxPoolSize=Config.MONGO_MAX_POOL_SIZE,
+                minPoolSize=Config.MONGO_MIN_POOL_SIZE,
+                connectTimeoutMS=Config.MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                # 0 waits for a free connection without limit
+                waitQueueTimeoutMS=Config.MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+                event_listeners=[command_metrics, pool_metrics],
+            )
+        return _client
+
+
+def get_db():
+    """Returns the database of the configured storage engine: mongo (default), memory or sqlite"""
+    global _storage
+    if Config.STORAGE_ENGINE == "mongo":
+        return get_client()[Config.DB]
+    with _client_lock:
+        if _storage is None:
+            if Config.STORAGE_ENGINE == "memory":
+                _storage = MemoryDatabase()
+            elif Config.STORAGE_ENGINE == "sqlite":
+                _storage = SQLiteDatabase(Config.SQLITE_PATH)
+            else:
+                raise ValueError(f"Unknown storage engine {Config.STORAGE_ENGINE}, expected mongo, memory or sqlite")
+        return _storage
+
+
+def get_metrics() -> dict:
+    return {
+        "pool": pool_metrics.snapshot(),
+        "commands": command_metrics.snapshot(),
+        "poolSettings": {
+            "maxPoolSize": Config.MONGO_MAX_POOL_SIZE,
+            "minPoolSize": Config.MONGO_MIN_POOL_SIZE,
+        },
+    }
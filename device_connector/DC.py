@@ -1,6 +1,7 @@
 from soil_sen import SoilSen
 from MyMQTT import MyMQTT
 import requests
+import threading
 import time
 import json
 from typing import Literal
@@ -23,13 +24,22 @@ class DC():
         print(f"Catalog URL: {self.catalog_url}")
 
         # Get broker connection details and main topic from catalog service
-        self.set_broker()
-        self.set_main_topic()
+        self.bootstrap()
 
         # Set up MQTT topics for sensors and actuators
         self.sen_topic = self.main_topic + "/sensors/"
         self.act_topic = self.main_topic + "/actuators/"
+        # The first connection is followed by the initial registration, the later ones register again
+        self.connected_before = False
         self.client = MyMQTT(Config.MQTT_CLIENT_ID, self.broker, self.port, self)
+        if Config.PRESENCE_ENABLED:
+            # The registry keeps the devices alive while online, the broker reports them offline if the connection drops
+            device_ids = [device.get("deviceId") for device in self.devices_list]
+            self.client.setPresence(
+                f"{self.main_topic}/{Config.PRESENCE_TOPIC}/{Config.MQTT_CLIENT_ID}",
+                {"status": "online", "deviceIds": device_ids},
+                {"status": "offline", "deviceIds": device_ids}
+            )
         self.client.start()
         time.sleep(0.3)  # Brief delay to ensure MQTT connection is established
         # Subscribe to all actuator messages using wildcard (#)
@@ -61,27 +71,79 @@ class DC():
         # Choose request method based on ntry
         method = requests.put if ntry > 1 else requests.post
         
-        # Make request for each item
-        for item in items:
-            try:
-                print(f"Registering {type}: {item}")
-                req = method(self.catalog_url + endpoint, json=item)
+        # Register all the items with a single batch request
+        try:
+            print(f"Registering {len(items)} {type}: {[item.get('plantId', item.get('deviceId')) for item in items]}")
+            req = method(self.catalog_url + endpoint + "/batch", json=items)
+            result = req.json()
+            failed = result.get("content", {}).get("failed", {})
+            if failed:
+                print(f"Registration failed for {type} {list(failed.keys())}: {failed}")
+            else:
                 print(f"Registration successful for {type}")
 
-            except requests.exceptions.RequestException as e:
-                print(f"Registration failed for {type}: {e}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Registration failed for {type}: {e}")
+
+
+
+    def heartbeat(self):
+        """
+        Keeps the devices alive in the catalog with a lightweight heartbeat.
+        The full registration is only repeated if the catalog does not know some of them.
+        """
+        device_ids = [device.get("deviceId") for device in self.devices_list]
+        try:
+            req = requests.put(f"{self.catalog_url}/{Config.DEVICES_ENDPOINT}/heartbeat", json=device_ids)
+            result = req.json()
+            if result.get("success"):
+                print(f"Heartbeat sent for devices {device_ids}")
+                return
+            print(f"Heartbeat rejected: {result.get('message')}. Registering again...")
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Heartbeat failed: {e}")
+            return
+
+        self.registerer("plant", ntry=2)
+        self.registerer("devices", ntry=2)
 
 
 
-    def set_broker(self, retries=3, delay=5):
+    def connected(self):
+        """
+        Called by the MQTT client on every connection. Without heartbeats, a reconnection is the moment the catalog
+        may have dropped the devices, if the connector was offline longer than its cleanup threshold.
+        """
+        if not Config.PRESENCE_ENABLED:
+            return
+        if not self.connected_before:
+            self.connected_before = True
+            return
+        # Off paho's network thread, the registration blocks on HTTP requests
+        threading.Thread(target=self.register_again, daemon=True).start()
+
+
+    def register_again(self):
+        self.registerer("plant", ntry=2)
+        self.registerer("devices", ntry=2)
+        # Announced again now that the devices exist in the catalog
+        self.client.publishPresence()
+
+
+
+    def bootstrap(self, retries=3, delay=5):
         for attempt in range(retries):
             try:
-                req_b = requests.get(self.catalog_url + "/broker")
+                # Broker and main topic come together in a single request
+                req_b = requests.get(self.catalog_url + "/bootstrap")
                 req_b.raise_for_status()  # Raise an exception for HTTP errors
                 req_data = req_b.json()
-                broker_info = req_data.get("content", {})
+                bootstrap = req_data.get("content", {})
+                broker_info = bootstrap.get("broker") or {}
                 self.broker, self.port = broker_info.get("IP"), int(broker_info.get("port", 1883))
-                print("Broker's info received")
+                self.main_topic = bootstrap.get("mainTopic")
+                print("Broker's info and main topic received")
                 return {"success": True}
                 # Exit the function if successful
 
@@ -95,11 +157,6 @@ class DC():
                     raise ConnectionError("All attempts to get the broker's information have failed.")
 
 
-    def set_main_topic(self):
-        req = requests.get(self.catalog_url + "/main_topic")
-        self.main_topic = req.json().get("content", {})
-
-
     def data_collector(self):
         """
         Collects sensor data by taking multiple readings and publishing their average.
@@ -168,18 +225,21 @@ class DC():
     def handle_status_change(self, plant_id, command):
         # Get device with matching plant ID from catalog
         try:
-            response = requests.get(f"{self.catalog_url}/{Config.DEVICES_ENDPOINT}")
+            response = requests.get(
+                f"{self.catalog_url}/{Config.DEVICES_ENDPOINT}",
+                params={"plantId": int(plant_id), "deviceType": "actuator"}
+                )
             if response.json().get("success"):
                 devices = response.json().get("content", [])
-                matching_device = None
-                for device in devices:
-                    if (device.get("deviceLocation", {}).get("plantId") == int(plant_id) and 
-                        device.get("deviceType") == "actuator"):
-                        matching_device = device
-                        break
+                matching_device = next(iter(devices), None)
                 
                 if matching_device:
                     device_id = matching_device.get("deviceId")
+                    if Config.PRESENCE_ENABLED:
+                        # The registry reads it from the broker
+                        self.client.myPublish(f"{self.main_topic}/{Config.STATUS_TOPIC}/{device_id}", {"status": command})
+                        print(f"Published device {device_id} status {command}")
+                        return
                     # Update device status in catalog
                     status_data = {
                         "deviceId": device_id,
@@ -206,6 +266,9 @@ if __name__ == "__main__":
     print("\nInitial registration...")
     device_connector.registerer("plant", ntry=1)
     device_connector.registerer("devices", ntry=1)
+    if Config.PRESENCE_ENABLED:
+        # Announced again now that the devices exist in the catalog
+        device_connector.client.publishPresence()
     
     # Main loop: Collect data and re-register devices periodically
     print("\nEntering registration and data collection loop...")
@@ -216,8 +279,11 @@ if __name__ == "__main__":
             device_connector.data_collector()
             print()
         counter += 1
-        # Re-register devices periodically to maintain presence in catalog
+        # Send heartbeats periodically to maintain presence in catalog, or repeat the presence over MQTT
         if counter % Config.REGISTRATION_INTERVAL == 0:
-            device_connector.registerer("devices", ntry=2)
+            if Config.PRESENCE_ENABLED:
+                device_connector.client.publishPresence()
+            else:
+                device_connector.heartbeat()
         
     
\ No newline at end of file
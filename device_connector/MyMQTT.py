@@ -10,6 +10,10 @@ class MyMQTT:
         self.clientID = clientID
         self._topic = ""
         self._isSubscriber = False
+        # every subscribed topic, subscribed again on reconnection as the session is not kept by the broker
+        self._topics = []
+        # Retained presence message, published again on every (re)connection
+        self._presence = None
         # create an instance of paho.mqtt.client
         self._paho_mqtt = PahoMQTT.Client(clientID, True)
         # register the callback
@@ -18,6 +22,23 @@ class MyMQTT:
 
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
         print("Connected to %s with result code: %d" % (self.broker, rc))
+        if rc == 0:
+            for topic in self._topics:
+                self._paho_mqtt.subscribe(topic, 2)
+            self.publishPresence()
+            # lets the notifier react to the (re)connections, if it wants to
+            if hasattr(self.notifier, "connected"):
+                self.notifier.connected()
+
+    def setPresence(self, topic, online_msg, offline_msg):
+        # the broker publishes offline_msg as the Last Will if the connection drops, call it before start
+        self._paho_mqtt.will_set(topic, json.dumps(offline_msg), 1, retain=True)
+        self._presence = (topic, online_msg)
+
+    def publishPresence(self):
+        # retained, so that a registry connecting later still receives it
+        if self._presence:
+            self._paho_mqtt.publish(self._presence[0], json.dumps(self._presence[1]), 1, retain=True)
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
         # A new message is received
@@ -34,6 +55,8 @@ class MyMQTT:
         # just to remember that it works also as a subscriber
         self._isSubscriber = True
         self._topic = topic
+        if topic not in self._topics:
+            self._topics.append(topic)
         print("subscribed to %s" % (topic))
 
     def start(self):
@@ -44,12 +67,14 @@ class MyMQTT:
     def unsubscribe(self):
         if (self._isSubscriber):
             # remember to unsuscribe if it is working also as subscriber
-            self._paho_mqtt.unsubscribe(self._topic)
+            for topic in self._topics:
+                self._paho_mqtt.unsubscribe(topic)
 
     def stop(self):
         if (self._isSubscriber):
             # remember to unsuscribe if it is working also as subscriber
-            self._paho_mqtt.unsubscribe(self._topic)
+            for topic in self._topics:
+                self._paho_mqtt.unsubscribe(topic)
 
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -15,6 +15,10 @@ class Config:
     DATA_POINTS_FOR_AVERAGE = int(os.getenv("DATA_POINTS_FOR_AVERAGE", 10))
     CONFIG_FILE = os.getenv("CONFIG_FILE")
     REGISTRATION_INTERVAL = int(os.getenv("REGISTRATION_INTERVAL"))
+    # Presence and status over MQTT instead of the HTTP heartbeats and status updates
+    PRESENCE_ENABLED = os.getenv("PRESENCE_ENABLED", "false").lower() in ["true", "1"]
+    PRESENCE_TOPIC = os.getenv("PRESENCE_TOPIC", "catalog/presence")
+    STATUS_TOPIC = os.getenv("STATUS_TOPIC", "catalog/status")
 
 
 class SensorConfig:
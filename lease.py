@@ -0,0 +1,73 @@
+'''Leases stored in the database, so that a task runs in a single registry replica at a time'''
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# Unique for each process, even with several replicas on the same host
+REPLICA_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class Lease:
+    """
+    Lease on a named task. One replica holds it and renews it before ttl seconds pass.
+    If that replica stops renewing it, the next replica to call acquire takes it over.
+    The collection needs a unique index on name.
+    """
+    def __init__(self, collection, name: str, ttl: int):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.holder = REPLICA_ID
+        self.held = False
+        # When the task last ran, whichever replica ran it
+        self.last_run = None
+
+    def acquire(self) -> bool:
+        """Takes or renews the lease, returns whether this replica holds it"""
+        now = datetime.now().replace(microsecond=0)
+        try:
+            before = self.collection.find_one_and_update(
+                {"name": self.name, "$or": [{"holder": self.holder}, {"expiresAt": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expiresAt": now + timedelta(seconds=self.ttl)}},
+                projection={"_id": 0, "holder": 1, "lastRun": 1},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # The lease exists and another replica holds it
+            if self.held:
+                print(f"Lease {self.name} lost by {self.holder}")
+            self.held = False
+            return False
+        except PyMongoError as e:
+            print(f"Failed to acquire the lease {self.name}: {e}")
+            self.held = False
+            return False
+
+        if not self.held:
+            print(f"Lease {self.name} acquired by {self.holder}")
+        self.held = True
+        self.last_run = (before or {}).get("lastRun")
+        return True
+
+    def due(self, interval: int) -> bool:
+        """Whether interval seconds passed since the task last ran"""
+        return self.last_run is None or datetime.now() - self.last_run >= timedelta(seconds=interval)
+
+    def record_run(self):
+        self.last_run = datetime.now().replace(microsecond=0)
+        try:
+            self.collection.update_one({"name": self.name, "holder": self.holder}, {"$set": {"lastRun": self.last_run}})
+        except PyMongoError as e:
+            print(f"Failed to record the run of {self.name}: {e}")
+
+    def release(self):
+        """Lets another replica take the lease at once, on shutdown"""
+        if not self.held:
+            return
+        try:
+            self.collection.update_one({"name": self.name, "holder": self.holder}, {"$set": {"expiresAt": datetime.min}})
+        except PyMongoError as e:
+            print(f"Failed to release the lease {self.name}: {e}")
+        self.held = False
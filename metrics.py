@@ -0,0 +1,172 @@
+'''Latency and throughput metrics of the registry, rendered in the Prometheus text format'''
+import threading
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative histogram of observed durations, in seconds"""
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+
+    def render(self, name: str, labels: str = "") -> list:
+        separator = "," if labels else ""
+        label_set = f"{{{labels}}}" if labels else ""
+        lines = [f'{name}_bucket{{{labels}{separator}le="{bound}"}} {count}'
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{label_set} {self.sum}")
+        lines.append(f"{name}_count{label_set} {self.count}")
+        return lines
+
+
+class RegistryMetrics:
+    """Collects the HTTP request and cleanup metrics of the registry"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (method, endpoint) -> Histogram
+        self.latencies = {}
+        # (method, endpoint, status) -> count
+        self.requests = {}
+        self.cleanup_latency = Histogram()
+        self.cleanup_failures = 0
+        self.cleanup_deleted = {"plants": 0, "devices": 0}
+        # Reads served by another request's database load
+        self.coalesced = 0
+        self.status_updates = 0
+        self.status_writes = 0
+        self.status_flush_latency = Histogram()
+
+    def observe_request(self, method: str, endpoint: str, status: int, seconds: float):
+        with self.lock:
+            self.latencies.setdefault((method, endpoint), Histogram()).observe(seconds)
+            key = (method, endpoint, int(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def observe_cleanup(self, seconds: float, deleted_plants: int, deleted_devices: int, failed: bool = False):
+        with self.lock:
+            self.cleanup_latency.observe(seconds)
+            self.cleanup_deleted["plants"] += deleted_plants
+            self.cleanup_deleted["devices"] += deleted_devices
+            self.cleanup_failures += int(failed)
+
+    def observe_coalesced(self):
+        with self.lock:
+            self.coalesced += 1
+
+    def observe_status_update(self):
+        with self.lock:
+            self.status_updates += 1
+
+    def observe_status_flush(self, written: int, seconds: float):
+        with self.lock:
+            self.status_writes += written
+            self.status_flush_latency.observe(seconds)
+
+    def render(self, db_metrics: dict = None) -> str:
+        """Renders all the metrics, plus the database ones if given, in the Prometheus text format"""
+        with self.lock:
+            lines = [
+                "# HELP registry_request_duration_seconds Latency of the catalog HTTP requests.",
+                "# TYPE registry_request_duration_seconds histogram",
+            ]
+            for (method, endpoint), histogram in sorted(self.latencies.items()):
+                lines += histogram.render("registry_request_duration_seconds", f'method="{method}",endpoint="{endpoint}"')
+
+            lines += [
+                "# HELP registry_requests_total Catalog HTTP requests by response status.",
+                "# TYPE registry_requests_total counter",
+            ]
+            errors = {}
+            for (method, endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'registry_requests_total{{method="{method}",endpoint="{endpoint}",status="{status}"}} {count}')
+                if status >= 400:
+                    errors[(method, endpoint)] = errors.get((method, endpoint), 0) + count
+
+            lines += [
+                "# HELP registry_request_errors_total Catalog HTTP requests answered with a status of 400 or more.",
+                "# TYPE registry_request_errors_total counter",
+            ]
+            for (method, endpoint), count in sorted(errors.items()):
+                lines.append(f'registry_request_errors_total{{method="{method}",endpoint="{endpoint}"}} {count}')
+
+            lines += [
+                "# HELP registry_cleanup_duration_seconds Duration of the stale entries cleanup.",
+                "# TYPE registry_cleanup_duration_seconds histogram",
+            ]
+            lines += self.cleanup_latency.render("registry_cleanup_duration_seconds")
+            lines += [
+                "# HELP registry_cleanup_deleted_total Entries deleted by the cleanup.",
+                "# TYPE registry_cleanup_deleted_total counter",
+            ]
+            for entity, count in self.cleanup_deleted.items():
+                lines.append(f'registry_cleanup_deleted_total{{entity="{entity}"}} {count}')
+            lines += [
+                "# HELP registry_cleanup_failures_total Cleanups interrupted by a database error.",
+                "# TYPE registry_cleanup_failures_total counter",
+                f"registry_cleanup_failures_total {self.cleanup_failures}",
+                "# HELP registry_coalesced_reads_total Cache misses served by a concurrent identical database load.",
+                "# TYPE registry_coalesced_reads_total counter",
+                f"registry_coalesced_reads_total {self.coalesced}",
+                "# HELP registry_status_updates_total Device status updates received.",
+                "# TYPE registry_status_updates_total counter",
+                f"registry_status_updates_total {self.status_updates}",
+                "# HELP registry_status_writes_total Device statuses written, the latest of each device per flush.",
+                "# TYPE registry_status_writes_total counter",
+                f"registry_status_writes_total {self.status_writes}",
+                "# HELP registry_status_flush_duration_seconds Duration of the bulk writes of the buffered statuses.",
+                "# TYPE registry_status_flush_duration_seconds histogram",
+            ]
+            lines += self.status_flush_latency.render("registry_status_flush_duration_seconds")
+
+        if db_metrics:
+            lines += self._render_db(db_metrics)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_db(db_metrics: dict) -> list:
+        commands = db_metrics.get("commands", {})
+        lines = [
+            "# HELP registry_mongo_commands_total MongoDB commands sent by the registry.",
+            "# TYPE registry_mongo_commands_total counter",
+        ]
+        lines += [f'registry_mongo_commands_total{{command="{name}"}} {stats["count"]}' for name, stats in sorted(commands.items())]
+        lines += [
+            "# HELP registry_mongo_command_errors_total MongoDB commands that failed.",
+            "# TYPE registry_mongo_command_errors_total counter",
+        ]
+        lines += [f'registry_mongo_command_errors_total{{command="{name}"}} {stats["errors"]}' for name, stats in sorted(commands.items())]
+        lines += [
+            "# HELP registry_mongo_command_duration_seconds_total Time spent in MongoDB commands.",
+            "# TYPE registry_mongo_command_duration_seconds_total counter",
+        ]
+        lines += [f'registry_mongo_command_duration_seconds_total{{command="{name}"}} {stats["totalMs"] / 1000}' for name, stats in sorted(commands.items())]
+
+        pool = db_metrics.get("pool", {})
+        lines += [
+            "# HELP registry_mongo_connections Connections of the MongoDB pool.",
+            "# TYPE registry_mongo_connections gauge",
+            f'registry_mongo_connections{{state="open"}} {pool.get("openConnections", 0)}',
+            f'registry_mongo_connections{{state="in_use"}} {pool.get("inUse", 0)}',
+            "# HELP registry_mongo_checkout_wait_seconds_total Time spent waiting for a pooled connection.",
+            "# TYPE registry_mongo_checkout_wait_seconds_total counter",
+            f'registry_mongo_checkout_wait_seconds_total {pool.get("checkoutWaitTotalMs", 0) / 1000}',
+            "# HELP registry_mongo_checkouts_total Connections checked out of the pool.",
+            "# TYPE registry_mongo_checkouts_total counter",
+            f'registry_mongo_checkouts_total {pool.get("checkouts", 0)}',
+            "# HELP registry_mongo_checkout_failures_total Failed connection checkouts.",
+            "# TYPE registry_mongo_checkout_failures_total counter",
+            f'registry_mongo_checkout_failures_total {pool.get("checkoutFailures", 0)}',
+        ]
+        return lines
@@ -1,30 +1,34 @@
 """Pydantic models for validations and registration of plants and devices"""
 
 from pydantic import BaseModel, ValidationError, ConfigDict
-from pymongo import MongoClient
+from pymongo import UpdateOne
 from pymongo.errors import PyMongoError
 from datetime import datetime
-from typing import List, Optional, Dict, Literal, Any
+from typing import List, Optional, Dict, Literal, Any, Union
 from config import Config
 from utility import to_lower_camel_case, response_creator
+from database import get_db
 
-client = MongoClient(Config.MONGO_URL)
-db = client[Config.DB]
+db = get_db()
 plants_collection = db[Config.PLANTS_COLLECTION]
 devices_collection = db[Config.DEVICES_COLLECTION]
 users_collection = db[Config.USERS_COLLECTION]
 
 
 class BaseModelWithTimestamp(BaseModel):
-    last_updated: Optional[str] = None
+    # Stored as a BSON date, strings are still accepted from the clients and overwritten on save
+    last_updated: Optional[Union[datetime, str]] = None
+    # Only changed by the writes of the content, unlike last_updated which the keep-alives refresh too
+    last_modified: Optional[Union[datetime, str]] = None
     # Lets the model to accept both camel and snake case. 
     # Plus, providing option to dump in both ways
     model_config = ConfigDict(
         alias_generator=to_lower_camel_case, populate_by_name=True
     )
     def model_dump_with_time(self, by_alias: bool = True, exclude_unset: bool = True) -> dict:
-        """Adds a timestamp to the model before dumping"""
-        self.last_updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        """Adds the timestamps to the model before dumping"""
+        self.last_updated = datetime.now().replace(microsecond=0)
+        self.last_modified = self.last_updated
         # Change the difult dump to be camelCase
         return self.model_dump(by_alias=by_alias, exclude_unset=exclude_unset)
 
@@ -72,13 +76,18 @@ class Device(BaseModelWithTimestamp):
                 raise ValueError(f"Invalid device status: {self.device_status}. Must be one of {self.status_options}")
                 
             plant_id = self.device_location.plant_id
+            device_data = self.model_dump_with_time()
 
-            # Check if the device's plant exists in the database
-            self._check_plant_exists(plant_id)
-            
-            self._upsert_device()
+            # Checks the plant's existence and adds the device to its inventory in one round trip
+            already_in_inventory = self._add_to_plant_inventory(plant_id)
 
-            self._update_plant_device_inventory(plant_id)
+            try:
+                self._upsert_device(device_data)
+            except PyMongoError:
+                # Without a transaction, the inventory change is undone by hand
+                if not already_in_inventory:
+                    plants_collection.update_one({"plantId": plant_id}, {"$pull": {"deviceInventory": self.device_id}})
+                raise
 
         except Exception as e:
             print(f"Error saving device {self.device_id} to database: {str(e)}")
@@ -87,16 +96,93 @@ class Device(BaseModelWithTimestamp):
         return response_creator(True, message="Device registered successfully", status=200)
 
 
+    @classmethod
+    def save_many_to_db(cls, devices: List["Device"], failed: Dict[str, str] = None) -> dict:
+        """
+        Registers a batch of devices with one bulk write on the devices collection
+        and a single $addToSet per plant on the plants collection.
+        Devices with an invalid status or a missing plant are added to failed.
+        """
+        print()
+        failed = failed if failed is not None else {}
+        # The last definition wins if a device appears more than once
+        to_save = {}
+        for device in devices:
+            if not device.is_valid_status:
+                failed[str(device.device_id)] = f"Invalid device status: {device.device_status}. Must be one of {device.status_options}"
+            else:
+                to_save[device.device_id] = device
+
+        inventories = {}
+        try:
+            plant_ids = list({device.device_location.plant_id for device in to_save.values()})
+            existing_plants = {plant["plantId"]: set(plant.get("deviceInventory", [])) for plant in plants_collection.find(
+                {"plantId": {"$in": plant_ids}}, {"_id": 0, "plantId": 1, "deviceInventory": 1})}
+
+            device_operations = []
+            for device in to_save.values():
+                plant_id = device.device_location.plant_id
+                if plant_id not in existing_plants:
+                    failed[str(device.device_id)] = f"Plant with id {plant_id} does not exist."
+                    continue
+                device_operations.append(
+                    UpdateOne({"deviceId": device.device_id}, {"$set": device.model_dump_with_time()}, upsert=True)
+                )
+                inventories.setdefault(plant_id, []).append(device.device_id)
+
+            if device_operations:
+                devices_collection.bulk_write(device_operations, ordered=False)
+                last_updated = datetime.now().replace(microsecond=0)
+                plants_collection.bulk_write([
+                    UpdateOne(
+                        {"plantId": plant_id},
+                        {
+                            "$addToSet": {"deviceInventory": {"$each": device_ids}},
+                            # lastModified only moves for the inventories which gain a device
+                            "$set": {"lastUpdated": last_updated} if set(device_ids) <= existing_plants[plant_id]
+                                    else {"lastUpdated": last_updated, "lastModified": last_updated}
+                        }
+                    )
+                    for plant_id, device_ids in inventories.items()
+                ], ordered=False)
+
+        except PyMongoError as e:
+            print(f"Error saving the devices batch to database: {str(e)}")
+            return response_creator(False, message=f"Failed to register the devices: {str(e)}", status=500)
+
+        registered = [device_id for device_ids in inventories.values() for device_id in device_ids]
+        print(f"{len(registered)} devices registered, {len(failed)} failed.")
+        return response_creator(
+            not failed,
+            content={"registered": registered, "failed": failed},
+            message=f"{len(registered)} devices registered successfully",
+            status=200 if registered or not failed else 400
+        )
+
+
     ### Helper functions
-    def _check_plant_exists(self, plant_id: int):
-        plant = plants_collection.find_one({"plantId": plant_id})
-        if not plant:
+    # Plus, updates plant's last update too, and lastModified if the inventory gains the device.
+    # Returns whether the device was already in the inventory
+    def _add_to_plant_inventory(self, plant_id: int) -> bool:
+        # Both updates go in one round trip, the first one only matches if the device is new to the inventory
+        result = plants_collection.bulk_write([
+            UpdateOne(
+                {"plantId": plant_id, "deviceInventory": {"$ne": self.device_id}},
+                {
+                    "$addToSet": {"deviceInventory": self.device_id},
+                    "$set": {"lastUpdated": self.last_updated, "lastModified": self.last_updated}
+                }
+            ),
+            UpdateOne({"plantId": plant_id}, {"$set": {"lastUpdated": self.last_updated}}),
+        ])
+        if result.matched_count == 0:
             print(f"Plant with id {plant_id} does not exist.")
             raise ValueError(f"Plant with id {plant_id} does not exist.")
+        print(f"Device id {self.device_id} upserted to plant {plant_id} device_inventory.")
+        return result.matched_count == 1
     
         
-    def _upsert_device(self):
-        device_data = self.model_dump_with_time()
+    def _upsert_device(self, device_data: dict):
         device_update_result = devices_collection.update_one(
             {'deviceId': self.device_id},
             {'$set': device_data},
@@ -107,17 +193,6 @@ class Device(BaseModelWithTimestamp):
         else:
             print(f"Updated existing device with ID {self.device_id}.")
 
-    # Plus, updates plant's last update too
-    def _update_plant_device_inventory(self, plant_id: int):
-        plants_collection.update_one(
-            {'plantId': plant_id},
-            {
-                '$addToSet': {'deviceInventory': self.device_id},
-                '$set': {'lastUpdated': self.last_updated}
-            }
-        )
-        print(f"Device id {self.device_id} upserted to plant {plant_id} device_inventory.")
-
 
 
 class Plant(BaseModelWithTimestamp):
@@ -146,18 +221,12 @@ class Plant(BaseModelWithTimestamp):
                 raise ValueError(f"Invalid plant_date format: {self.plant_date}. Must be YYYY-MM-DD")
             print(f"""Starting update/insert for plant {self.plant_id}...""")
 
-            # Check if the plant already exists in the database
-            existing_plant = plants_collection.find_one({"plantId": self.plant_id})
-    
-            # Prepare the data to update, excluding device_inventory if the plant already exists
+            # Prepare the data to update, the device inventory is only initialized
+            # by the upsert for new plants, so existing ones keep theirs
             updated_data = self.model_dump_with_time()
+            updated_data.pop("deviceInventory", None)
 
-            if existing_plant:
-                print(f"Plant {self.plant_id} already exists in the database. Preparing to update.")
-                # If the plant exists, we want to update only specific fields excluding device_inventory
-                updated_data.pop("deviceInventory", None)
-            
-            # Perform the update or insert (upsert) for the plant in the transaction
+            # Perform the update or insert (upsert) for the plant
             self._upsert_plant(updated_data)
 
         except PyMongoError as e:
@@ -167,10 +236,49 @@ class Plant(BaseModelWithTimestamp):
         # print(f"Exiting save_to_db method for plant_id: {self.plant_id}\n")
         return response_creator(True, message="Plant registered successfully", status=200)
 
+    @classmethod
+    def save_many_to_db(cls, plants: List["Plant"], failed: Dict[str, str] = None) -> dict:
+        """
+        Registers a batch of plants with one bulk write.
+        The device inventory is only initialized for new plants, existing ones keep theirs.
+        Plants with an invalid date are added to failed.
+        """
+        print()
+        failed = failed if failed is not None else {}
+        # The last definition wins if a plant appears more than once
+        operations = {}
+        for plant in plants:
+            if not plant.is_valid_date:
+                failed[str(plant.plant_id)] = f"Invalid plant_date format: {plant.plant_date}. Must be YYYY-MM-DD"
+                continue
+            updated_data = plant.model_dump_with_time()
+            updated_data.pop("deviceInventory", None)
+            operations[plant.plant_id] = UpdateOne(
+                {"plantId": plant.plant_id},
+                {"$set": updated_data, "$setOnInsert": {"deviceInventory": []}},
+                upsert=True
+            )
+
+        try:
+            if operations:
+                plants_collection.bulk_write(list(operations.values()), ordered=False)
+        except PyMongoError as e:
+            print(f"Error saving the plants batch to database: {str(e)}")
+            return response_creator(False, message=f"Failed to register the plants: {str(e)}", status=500)
+
+        registered = list(operations.keys())
+        print(f"{len(registered)} plants registered, {len(failed)} failed.")
+        return response_creator(
+            not failed,
+            content={"registered": registered, "failed": failed},
+            message=f"{len(registered)} plants registered successfully",
+            status=200 if registered or not failed else 400
+        )
+
     def _upsert_plant(self, updated_data: dict) -> None:
         plant_update_result = plants_collection.update_one(
             {"plantId": self.plant_id},
-            {"$set": updated_data},
+            {"$set": updated_data, "$setOnInsert": {"deviceInventory": []}},
             upsert=True,
         )
         if plant_update_result.upserted_id:
@@ -273,6 +381,48 @@ if __name__ == "__main__":
         # param1 = DeviceParam(**params)
         # print(param1.model_dump())
 
+    ### micro-benchmark of the device write path against the configured database
+    def bench_device_save(n: int = 300):
+        import io, time
+        from contextlib import redirect_stdout
+
+        Plant(plantId=901, plantDate="2025-01-01", deviceInventory=[]).save_to_db()
+        def bench_device(device_id: int) -> Device:
+            return Device(
+                deviceId=device_id, deviceType="sensor", deviceName="bench_sensor",
+                deviceStatus="ON", statusOptions=["ON"], deviceLocation={"plantId": 901},
+                measureTypes=["temperature"], availableServices=["MQTT"],
+                servicesDetails=[{"serviceType": "MQTT"}]
+            )
+
+        # The former path: plant check, device upsert and inventory update in three round trips
+        def former_save(device: Device):
+            if not plants_collection.find_one({"plantId": 901}):
+                raise ValueError("Plant with id 901 does not exist.")
+            devices_collection.update_one({"deviceId": device.device_id}, {"$set": device.model_dump_with_time()}, upsert=True)
+            plants_collection.update_one(
+                {"plantId": 901},
+                {"$addToSet": {"deviceInventory": device.device_id}, "$set": {"lastUpdated": device.last_updated}}
+            )
+
+        # A device saved again, already in the inventory, and n devices new to it
+        existing = bench_device(90100)
+        for case, first_id in [("existing", None), ("new", 91000)]:
+            for name, save in [("former", former_save), ("current", Device.save_to_db)]:
+                devices = [existing] * n if first_id is None else [bench_device(first_id + i) for i in range(n)]
+                with redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    for device in devices:
+                        save(device)
+                    elapsed = time.perf_counter() - start
+                print(f"{name} save of {case} devices: {elapsed / n * 1000:.3f} ms per call over {n} calls")
+                if first_id is not None:
+                    devices_collection.delete_many({"deviceId": {"$gte": first_id}})
+                    plants_collection.update_one({"plantId": 901}, {"$pull": {"deviceInventory": {"$gte": first_id}}})
+
+        devices_collection.delete_many({"deviceId": {"$gte": 90100}})
+        plants_collection.delete_one({"plantId": 901})
+
     def dparam():
         dparams = {
             'device_type': 'sensor'
@@ -290,3 +440,4 @@ if __name__ == "__main__":
     # d()
     # pa()
     # dparam()
+    # bench_device_save()
@@ -1,16 +1,15 @@
-from pymongo import MongoClient
+from config import Config
+from database import get_db
 
-# Connect to MongoDB
-client = MongoClient("mongodb://localhost:27018/")
-
-# Specify the database
-db_name = 'catalog'
-db = client[db_name]
+# Connect to the database of the configured storage engine
+db_name = Config.DB
+db = get_db()
 
 # Create collections 'plants' and 'general'
 plants_collection = db['plants']
 general_collection = db['general']
 devices_collection = db['devices']
+users_collection = db['users']
 
 # Primary info to insert into 'general' collection
 broker = {
@@ -39,7 +38,7 @@ def check_insert(update_result):
 
 
 
-if __name__ == "__main__":
+def setup():
     # Update or insert documents into 'general' collection
     update_result = general_collection.update_one(
         {"broker": {"$exists": True}},
@@ -54,6 +53,42 @@ if __name__ == "__main__":
         upsert=True
     )
     check_insert(update_result)
+
+    # Unique indexes for single item lookups (no-op if they already exist)
+    plants_collection.create_index("plantId", unique=True)
+    devices_collection.create_index("deviceId", unique=True)
+    users_collection.create_index("userId", unique=True)
+    # Indexes for the filtered device queries
+    # deviceId and deviceStatus cover the ?fields=deviceId,deviceStatus lookups without reading the documents
+    devices_collection.create_index([("deviceLocation.plantId", 1), ("deviceType", 1), ("deviceId", 1), ("deviceStatus", 1)])
+    devices_collection.create_index([("measureTypes", 1), ("deviceLocation.plantId", 1)])
+    plants_collection.create_index("deviceInventory")
+    plants_collection.create_index([("lastUpdated", 1), ("plantId", 1)])
+    devices_collection.create_index([("lastUpdated", 1), ("deviceId", 1)])
+    # Serve the ?since= delta queries
+    plants_collection.create_index([("lastModified", 1), ("plantId", 1)])
+    devices_collection.create_index([("lastModified", 1), ("deviceId", 1)])
+    users_collection.create_index([("lastModified", 1), ("userId", 1)])
+    # One lease per task run by a single registry replica
+    db['leases'].create_index("name", unique=True)
+
+    # Converts the lastUpdated strings of older versions to dates
+    for collection in [plants_collection, devices_collection, users_collection]:
+        result = collection.update_many(
+            {"lastUpdated": {"$type": "string"}},
+            [{"$set": {"lastUpdated": {"$dateFromString": {
+                "dateString": "$lastUpdated",
+                "format": "%Y-%m-%d %H:%M:%S",
+                "onError": "$$NOW",
+                "onNull": "$$NOW"
+            }}}}]
+        )
+        print(f"Converted lastUpdated of {result.modified_count} documents in {collection.name}.")
+    print("Indexes on plantId, deviceId, userId and the device filters are in place.")
     
     # Confirmation message
-    print(f"Database '{db_name}' with collections 'plants' and 'general' has been set up.")
\ No newline at end of file
+    print(f"Database '{db_name}' with collections 'plants' and 'general' has been set up.")
+
+
+if __name__ == "__main__":
+    setup()
@@ -1,19 +1,145 @@
 import cherrypy
 import datetime
+import functools
+import json
+import re
+import sys
+import threading
 import time
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+import types
+import zlib
+from typing import List
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
 from config import Config
 from models import Plant, Device, User
-from utility import response_creator
+from utility import response_creator, json_serializer, content_hash, TIME_FORMAT
+from database import get_db, get_metrics
+from metrics import RegistryMetrics
+from MyMQTT import MyMQTT
+from lease import Lease, REPLICA_ID
+from status_buffer import StatusBuffer
 
-# MongoDB Configuration
-client = MongoClient(Config.MONGO_URL)
-db = client[Config.DB]
+# MongoDB Configuration, the client and its pool are shared with the models
+db = get_db()
 plants_collection = db[Config.PLANTS_COLLECTION]
 general_collection = db[Config.GENERAL_COLLECTION]
 devices_collection = db[Config.DEVICES_COLLECTION]
 users_collection = db[Config.USERS_COLLECTION]
+# Records the ids deleted by the cleanup for the delta queries
+tombstones_collection = db[Config.TOMBSTONES_COLLECTION]
+# Leases of the tasks run by a single replica
+leases_collection = db[Config.LEASES_COLLECTION]
+
+# Entity name to its collection and id key
+collections = {
+    "plants": (plants_collection, "plantId"),
+    "devices": (devices_collection, "deviceId"),
+    "users": (users_collection, "userId"),
+}
+entity_models = {"plants": Plant, "devices": Device, "users": User}
+# Accepted names of the fields parameter, dotted paths included
+FIELD_NAME = re.compile(r"[A-Za-z_]\w*(\.[A-Za-z_]\w*)*")
+
+
+
+registry_metrics = RegistryMetrics()
+# Endpoint labels of the metrics, anything else is reported as "other" to bound their number
+KNOWN_ENDPOINTS = ["broker", "main_topic", "bootstrap", "db_metrics", "general", "plants", "devices", "users"]
+KNOWN_SUB_ENDPOINTS = ["status", "batch", "heartbeat", "reload", "watch"]
+
+
+def endpoint_label(uri: tuple) -> str:
+    """Turns the request path into a metrics label, such as devices/status or devices/{id}"""
+    if not uri:
+        return "/"
+    label = uri[0].lower() if uri[0].lower() in KNOWN_ENDPOINTS else "other"
+    if len(uri) > 1:
+        sub_endpoint = "{id}" if uri[1].isdigit() else uri[1] if uri[1] in KNOWN_SUB_ENDPOINTS else "other"
+        label += "/" + sub_endpoint
+    return label
+
+
+def measured(handler):
+    """Records the latency and the response status of a Catalog HTTP method"""
+    @functools.wraps(handler)
+    def wrapper(self, *uri, **params):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = handler(self, *uri, **params)
+            # Most responses carry their status in the body only
+            status = response.get("status", 200) if isinstance(response, dict) else 200
+            return response
+        except cherrypy.HTTPRedirect as redirect:
+            status = redirect.status
+            raise
+        except cherrypy.HTTPError as error:
+            status = error.status
+            raise
+        finally:
+            registry_metrics.observe_request(cherrypy.request.method, endpoint_label(uri), status, time.perf_counter() - start)
+    return wrapper
+
+
+# Encodes the responses, orjson when installed unless JSON_SERIALIZER is set to json
+dumps = json_serializer(Config.JSON_SERIALIZER)
+
+
+def json_handler(*args, **kwargs):
+    """json_out handler which also serializes the datetimes of the documents"""
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    if isinstance(value, types.GeneratorType):
+        # Streamed responses are already encoded chunk by chunk
+        return value
+    return dumps(value)
+
+
+def _deflate(body, compress_level: int):
+    compressor = zlib.compressobj(compress_level)
+    for chunk in body:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def compress_response(min_size: int = 1024, compress_level: int = 5,
+                      mime_types: tuple = ("application/json", "application/x-ndjson", "text/plain")):
+    """
+    Compresses the response with gzip or deflate, whichever the client prefers in Accept-Encoding.
+    Bodies smaller than min_size are sent as they are, streamed ones are always compressed.
+    """
+    request, response = cherrypy.serving.request, cherrypy.serving.response
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if content_type not in mime_types or "Content-Encoding" in response.headers:
+        return
+    # The representation depends on the header even when it is not compressed
+    cherrypy.lib.set_vary_header(response, "Accept-Encoding")
+    if not response.stream and len(response.collapse_body()) < min_size:
+        return
+
+    for coding in request.headers.elements("Accept-Encoding"):
+        if coding.qvalue == 0:
+            continue
+        if coding.value in ["gzip", "x-gzip"]:
+            response.body = cherrypy.lib.encoding.compress(response.body, compress_level)
+        elif coding.value == "deflate":
+            response.body = _deflate(response.body, compress_level)
+        else:
+            continue
+        response.headers["Content-Encoding"] = coding.value
+        response.headers.pop("Content-Length", None)
+        return
+
+
+cherrypy.tools.compress = cherrypy.Tool("before_finalize", compress_response, priority=80)
+
+
+class Flight:
+    """A database load shared by the concurrent requests of the same cache key"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
 
 
 
@@ -31,33 +157,336 @@ class Catalog():
 
         self.threshold = Config.CLEANUP_THRESHOLD
         self.interval = Config.CLEANUP_INTERVAL
+        self.tombstones_retention = Config.TOMBSTONES_RETENTION
 
-        self.get_broker()
-        self.get_main_topic()
+        # In-memory read cache. Every entity has a version which is bumped by each write,
+        # dropping its cached entries and changing the ETag served to the clients.
+        self.cache = {}
+        self.versions = {"plants": 0, "devices": 0, "users": 0, "general": 0}
+        self.cache_lock = threading.Lock()
+        # Notified on every version bump, wakes up the watch requests
+        self.version_changed = threading.Condition(self.cache_lock)
+        # Bounds the worker threads held by the watch requests
+        self.watchers = threading.BoundedSemaphore(Config.WATCH_MAX_CLIENTS)
+        # Loads in progress by (entity, key), joined by the identical requests arriving meanwhile
+        self.flights = {}
+        # Distinguishes the ETags of different runs and replicas of the registry
+        self.epoch = time.time_ns() // 1000
 
+        # Hash of the last payload saved for each (entity, id), to skip the unchanged re-registrations
+        self.content_hashes = {}
 
-    def get_broker(self):
+        self.broker = None
+        self.main_topic = None
+        # Publishes the change events, connected by start_change_events
+        self.mqtt_client = None
+        # Whether the change events of the other replicas reach the caches, see drop_caches
+        self.events_connected = False
+        # Status updates are written behind, a few milliseconds later and together
+        self.status_buffer = StatusBuffer(
+            devices_collection, Config.STATUS_FLUSH_INTERVAL_MS / 1000, Config.STATUS_FLUSH_MAX_ENTRIES, self._status_flushed
+        )
+        self.status_buffer.start()
+        self.create_indexes()
+        self.migrate_timestamps()
+        self.reload_general()
+
+
+    def create_indexes(self):
+        """Creates the indexes used by single item lookups and device filters. Safe to call repeatedly."""
+        indexes = [
+            (plants_collection, "plantId", {"unique": True}),
+            (devices_collection, "deviceId", {"unique": True}),
+            (users_collection, "userId", {"unique": True}),
+            # Serve the filtered /devices queries (by plant, type and measure type)
+            # deviceId and deviceStatus cover the ?fields=deviceId,deviceStatus lookups without reading the documents
+            (devices_collection, [("deviceLocation.plantId", 1), ("deviceType", 1), ("deviceId", 1), ("deviceStatus", 1)], {}),
+            (devices_collection, [("measureTypes", 1), ("deviceLocation.plantId", 1)], {}),
+            # Finds the plants hosting a device on heartbeats
+            (plants_collection, "deviceInventory", {}),
+            # Cover the stale entries lookup of the cleanup
+            (plants_collection, [("lastUpdated", 1), ("plantId", 1)], {}),
+            (devices_collection, [("lastUpdated", 1), ("deviceId", 1)], {}),
+            # Serve the ?since= delta queries
+            (plants_collection, [("lastModified", 1), ("plantId", 1)], {}),
+            (devices_collection, [("lastModified", 1), ("deviceId", 1)], {}),
+            (users_collection, [("lastModified", 1), ("userId", 1)], {}),
+            # Tombstones are looked up by entity and time
+            (tombstones_collection, [("entity", 1), ("deletedAt", 1)], {}),
+            # The leases are only exclusive with it
+            (leases_collection, "name", {"unique": True}),
+            # Finds the online devices before each cleanup
+            (devices_collection, [("online", 1), ("presenceAt", 1)], {"sparse": True}),
+        ]
+        # One failure does not prevent the other indexes
+        for collection, keys, options in indexes:
+            try:
+                collection.create_index(keys, **options)
+            except PyMongoError as e:
+                print(f"An error occurred while creating the index {keys} on {collection.name}: {e}")
+        self._expire_tombstones()
+
+
+    def _expire_tombstones(self):
+        """
+        Makes the tombstones expire after TOMBSTONES_RETENTION. An existing TTL index keeps the expiry it was
+        created with, so a changed retention is applied with collMod. If that fails, the delta queries use
+        the expiry actually in force to tell when the tombstones of a period are gone.
+        """
+        expire_after = self.tombstones_retention * 60
         try:
-            result = general_collection.find_one({"broker": {"$exists": True}}, {"_id": 0, "broker": 1})
-            if result and "broker" in result:
-                self.broker = result["broker"]
-                print(f"Broker found: {self.broker}")
-            else:
-                print("Broker not found in general collection.")
+            tombstones_collection.create_index("deletedAt", expireAfterSeconds=expire_after)
+            return
+        except OperationFailure as e:
+            print(f"Tombstones expiry differs from TOMBSTONES_RETENTION, updating it: {e}")
+        except PyMongoError as e:
+            print(f"An error occurred while creating the tombstones expiry index: {e}")
+            return
+        try:
+            db.command({
+                "collMod": tombstones_collection.name,
+                "index": {"keyPattern": {"deletedAt": 1}, "expireAfterSeconds": expire_after}
+            })
+        except PyMongoError as e:
+            print(f"Failed to update the tombstones expiry: {e}")
+            try:
+                index = tombstones_collection.index_information().get("deletedAt_1", {})
+                if "expireAfterSeconds" in index:
+                    self.tombstones_retention = index["expireAfterSeconds"] / 60
+                    print(f"Delta queries use the current tombstones retention of {self.tombstones_retention} minutes")
+            except PyMongoError as e:
+                print(f"Failed to read the tombstones expiry: {e}")
+
+
+    def migrate_timestamps(self):
+        """
+        Converts the lastUpdated strings written by older versions to BSON dates,
+        and starts the lastModified of their documents from lastUpdated. Safe to call repeatedly.
+        """
+        conversion = [{"$set": {"lastUpdated": {"$dateFromString": {
+            "dateString": "$lastUpdated",
+            "format": "%Y-%m-%d %H:%M:%S",
+            # Unparsable timestamps are considered fresh, the next update will fix them
+            "onError": "$$NOW",
+            "onNull": "$$NOW"
+        }}}}]
+        try:
+            for collection in [plants_collection, devices_collection, users_collection]:
+                result = collection.update_many({"lastUpdated": {"$type": "string"}}, conversion)
+                if result.modified_count:
+                    print(f"Converted lastUpdated of {result.modified_count} documents in {collection.name}")
+        except PyMongoError as e:
+            print(f"An error occurred while migrating the timestamps: {e}")
+        try:
+            for entity, (collection, id_key) in collections.items():
+                # Written one by one, the storage engines do not run update pipelines
+                operations = [
+                    UpdateOne({id_key: document[id_key]}, {"$set": {"lastModified": document.get("lastUpdated")}})
+                    for document in collection.find({"lastModified": {"$exists": False}}, {"_id": 0, id_key: 1, "lastUpdated": 1})
+                ]
+                if operations:
+                    collection.bulk_write(operations, ordered=False)
+                    print(f"Set lastModified of {len(operations)} documents in {collection.name}")
+        except PyMongoError as e:
+            print(f"An error occurred while migrating the timestamps: {e}")
+
+
+    def _cached(self, entity: str, key, loader):
+        """
+        Returns the cached value of the key, loading it from the database on a miss.
+        Concurrent misses of the same key wait for the first one's load instead of querying again.
+        """
+        with self.cache_lock:
+            if (entity, key) in self.cache:
+                return self.cache[(entity, key)]
+            flight = self.flights.get((entity, key))
+            leader = flight is None
+            if leader:
+                flight = self.flights[(entity, key)] = Flight()
+                version = self.versions[entity]
+
+        if not leader:
+            registry_metrics.observe_coalesced()
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
         except Exception as e:
-            print(F"An error occurred while retrieving the broker: {e}")
+            flight.error = e
+            raise
+        finally:
+            with self.cache_lock:
+                # Only store the value if no write happened on the entity while loading it
+                if flight.value is not None and self.versions[entity] == version:
+                    self.cache[(entity, key)] = flight.value
+                if self.flights.get((entity, key)) is flight:
+                    del self.flights[(entity, key)]
+            flight.done.set()
+        return flight.value
 
 
-    def get_main_topic(self):
+    def invalidate(self, *entities: str):
+        """Drops the cached entries of the entities after a write and bumps their versions"""
+        with self.cache_lock:
+            for entity in entities:
+                self.versions[entity] += 1
+            self.cache = {key: value for key, value in self.cache.items() if key[0] not in entities}
+            # Requests arriving after the write must not join a load which may have read the old data
+            self.flights = {key: flight for key, flight in self.flights.items() if key[0] not in entities}
+            self.version_changed.notify_all()
+
+
+    def wait_for_change(self, entity: str, version: int, timeout: float) -> int:
+        """Waits up to timeout seconds for the entity's version to differ from version, returns the current one"""
+        with self.version_changed:
+            self.version_changed.wait_for(lambda: self.versions[entity] != version, timeout)
+            return self.versions[entity]
+
+
+    def _check_etag(self, entity: str):
+        """Sets the entity's ETag on the response, answering 304 if the client's copy is current"""
+        with self.cache_lock:
+            etag = f'"{self.epoch}-{entity}-{self.versions[entity]}"'
+        cherrypy.response.headers["ETag"] = etag
+        if_none_match = cherrypy.request.headers.get("If-None-Match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            # Sends an empty 304 Not Modified
+            raise cherrypy.HTTPRedirect([], 304)
+
+
+    def reload_general(self):
+        """
+        Loads the broker and the main topic from the general collection with one query.
+        They are kept in memory and only change with a reload, which bumps their ETag.
+        """
         try:
-            result = general_collection.find_one({"mainTopic": {"$exists": True}}, {"_id": 0, "mainTopic": 1})
-            if result and "mainTopic" in result:
-                self.main_topic = result["mainTopic"]
-                print(f"MainTopic found: {self.main_topic}")
-            else:
-                print("Main topic not found in general collection.")
+            general = {}
+            for document in general_collection.find({}, {"_id": 0}):
+                general.update(document)
+        except PyMongoError as e:
+            print(F"An error occurred while retrieving the general config: {e}")
+            return
+
+        broker, main_topic = general.get("broker"), general.get("mainTopic")
+        if broker is None:
+            print("Broker not found in general collection.")
+        if main_topic is None:
+            print("Main topic not found in general collection.")
+
+        if (broker, main_topic) != (self.broker, self.main_topic):
+            self.broker, self.main_topic = broker, main_topic
+            print(f"Broker found: {self.broker}, MainTopic found: {self.main_topic}")
+            self.invalidate("general")
+
+
+    def start_change_events(self):
+        """
+        Connects to the broker to publish the change events, and subscribes to the ones of the other replicas
+        to keep the read caches current. The registry keeps working without it, dropping its caches
+        every CACHE_TTL seconds instead.
+        """
+        broker = self.get_broker()
+        if not broker:
+            print("Change events disabled, no broker configured.")
+            return
+        try:
+            # The broker disconnects a client when another one connects with the same id
+            mqtt_client = MyMQTT(f"{Config.REGISTRY_MQTT_CLIENT_ID}-{REPLICA_ID}", broker.get("IP"), int(broker.get("port", 1883)), self)
+            if self.main_topic:
+                # Subscribed on every connection, before the caches count as current
+                mqtt_client.mySubscribe(f"{self.main_topic}/{Config.CHANGES_TOPIC}")
+            mqtt_client.start()
+            self.mqtt_client = mqtt_client
+        except (OSError, ValueError) as e:
+            print(f"Change events disabled, failed to connect to the broker: {e}")
+
+
+    def publish_change(self, entity: str, operation: str, ids: list, statuses: dict = None):
+        """
+        Publishes {"entity", "operation", "ids", "version", "epoch", "replica"} on {mainTopic}/catalog/changes.
+        operation is upsert or delete, or for devices status, with the new "statuses" by id, or presence when
+        only their online flag changed. touch means only lastUpdated was refreshed. version is the entity's version after the change, as in its ETag.
+        A device change also changes its plant's inventory, no separate plant event is sent for it.
+        """
+        if not ids or self.mqtt_client is None or not self.main_topic:
+            return
+        with self.cache_lock:
+            version = self.versions[entity]
+        event = {"entity": entity, "operation": operation, "ids": ids, "version": version, "epoch": self.epoch, "replica": REPLICA_ID}
+        if statuses is not None:
+            event["statuses"] = statuses
+        try:
+            self.mqtt_client.myPublish(f"{self.main_topic}/{Config.CHANGES_TOPIC}", event)
         except Exception as e:
-            print(F"An error occurred while retrieving the Main topic: {e}")
+            print(f"Failed to publish the {entity} change event: {e}")
+
+
+    def connected(self):
+        """Called by the MQTT client on every connection, the events sent while disconnected are lost"""
+        self.drop_caches()
+        self.events_connected = True
+
+
+    def disconnected(self):
+        self.events_connected = False
+
+
+    def drop_caches(self):
+        """
+        Drops the read caches and the content hashes, which only the change events keep current with the writes
+        of the other replicas. Called every CACHE_TTL seconds while the events are not connected.
+        """
+        self.content_hashes = {}
+        self.invalidate("plants", "devices", "users")
+
+
+    def apply_change(self, event: dict):
+        """
+        Applies a change event of another replica: drops the cached reads and the content hashes it makes outdated,
+        and wakes up the watch requests
+        """
+        if event.get("replica") == REPLICA_ID or event.get("entity") not in self.versions:
+            return
+        entity = event["entity"]
+        # A touch leaves the content as it was registered
+        if event.get("operation") != "touch":
+            for item_id in event.get("ids", []):
+                self._forget(entity, item_id)
+        if entity == "plants" and event.get("operation") == "delete":
+            # A re-created plant starts with an empty inventory, so its devices have to be saved in full
+            self.content_hashes = {key: value for key, value in self.content_hashes.items() if key[0] != "devices"}
+        # A device change also changes its plant's inventory, unless only its status or presence changed
+        if entity == "devices" and event.get("operation") not in ["status", "presence"]:
+            self.invalidate("devices", "plants")
+        else:
+            self.invalidate(entity)
+
+
+    def get_broker(self):
+        if self.broker is None:
+            self.reload_general()
+        return self.broker
+
+
+    def get_main_topic(self):
+        if self.main_topic is None:
+            self.reload_general()
+        return self.main_topic
+
+
+    def get_bootstrap(self, plant_ids: List[int] = None) -> dict:
+        """
+        Everything a service needs at startup in one response: the broker, the main topic and,
+        if plant ids are given, those plants and their devices.
+        """
+        bootstrap = {"broker": self.get_broker(), "mainTopic": self.get_main_topic()}
+        if plant_ids:
+            bootstrap["plants"] = list(plants_collection.find({"plantId": {"$in": plant_ids}}, self.defult_projection))
+            bootstrap["devices"] = self.get_all_devices({"deviceLocation.plantId": {"$in": plant_ids}})
+        return bootstrap
 
 
     # Get plants list
@@ -65,29 +494,291 @@ class Catalog():
         plants = plants_collection.find({}, self.defult_projection)
         return list(plants)
 
-    def get_all_devices(self):
-        devices = devices_collection.find({}, self.defult_projection)
+    def get_all_devices(self, query: dict = None):
+        devices = devices_collection.find(query or {}, self.defult_projection)
         return list(devices)    
     
     def get_all_users(self):
         users = users_collection.find({}, self.defult_projection)
         return list(users)
 
+    @staticmethod
+    def device_query(params: dict) -> dict:
+        """
+        Translates the /devices query parameters into a MongoDB filter.
+        Supported parameters: plantId, deviceType, measureType, deviceStatus
+        A repeated parameter matches any of its values.
+        Raises ValueError if plantId is not an integer.
+        """
+        def condition(value, cast=str):
+            # Repeated parameters arrive as a list
+            if isinstance(value, list):
+                return {"$in": [cast(item) for item in value]}
+            return cast(value)
+
+        query = {}
+        if params.get("plantId") is not None:
+            query["deviceLocation.plantId"] = condition(params["plantId"], int)
+        if params.get("deviceType"):
+            query["deviceType"] = condition(params["deviceType"])
+        if params.get("measureType"):
+            # Matches devices whose measureTypes list contains the value
+            query["measureTypes"] = condition(params["measureType"])
+        if params.get("deviceStatus"):
+            query["deviceStatus"] = condition(params["deviceStatus"])
+        return query
+
+    # Single item lookups, served by the unique id indexes
+    def get_plant(self, plant_id: int, projection: dict = None):
+        return plants_collection.find_one({"plantId": plant_id}, projection or self.defult_projection)
+
+    def get_device(self, device_id: int, projection: dict = None):
+        return devices_collection.find_one({"deviceId": device_id}, projection or self.defult_projection)
+
+    def get_user(self, user_id: int, projection: dict = None):
+        return users_collection.find_one({"userId": user_id}, projection or self.defult_projection)
+
     def delete_plant(self, plant_id: int):
         plants_collection.delete_one({"plantId": plant_id})
+        self._add_tombstones("plants", [plant_id])
 
     def delete_device(self, device_id: int):
         devices_collection.delete_one({"deviceId": device_id})
+        self._add_tombstones("devices", [device_id])
 
     def delete_user(self, user_id: int):
         users_collection.delete_one({"userId": user_id})
+        self._add_tombstones("users", [user_id])
+
+    def _add_tombstones(self, entity: str, ids: list):
+        if ids:
+            # In UTC, which the expiry by the TTL index compares with
+            deleted_at = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0, tzinfo=None)
+            tombstones_collection.insert_many(
+                [{"entity": entity, "id": item_id, "deletedAt": deleted_at} for item_id in ids],
+                ordered=False
+            )
+
+    def get_changes(self, entity: str, since: datetime.datetime, query: dict = None, projection: dict = None) -> dict:
+        """
+        Returns the entity's documents modified since the given time and the ids deleted since then.
+        The keep-alives only refresh lastUpdated, so they do not show up here.
+        Clients apply the deletions first, then the changes, and send back the cursor on the next poll.
+        If the tombstones of that period already expired, all the documents are returned with full
+        set to True, and the client replaces its copy.
+        """
+        # Taken before the queries, so that no write falls between two polls
+        cursor = datetime.datetime.now().replace(microsecond=0)
+        collection, _ = collections[entity]
+        query = query or {}
+        projection = projection or self.defult_projection
+
+        full = since < cursor - datetime.timedelta(minutes=self.tombstones_retention)
+        if full:
+            changes, deleted = list(collection.find(query, projection)), []
+        else:
+            changes = list(collection.find({**query, "lastModified": {"$gte": since}}, projection))
+            # since is in local time, the tombstones in UTC
+            since_utc = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            deleted = tombstones_collection.distinct("id", {"entity": entity, "deletedAt": {"$gte": since_utc}})
+        return {"changes": changes, "deleted": deleted, "cursor": cursor.strftime(TIME_FORMAT), "full": full}
+
+    @staticmethod
+    def projection(entity: str, params: dict) -> dict:
+        """
+        Translates the fields query parameter, a comma separated list such as deviceId,deviceStatus,
+        into a MongoDB projection. The id of the entity is always returned.
+        Raises ValueError on an invalid field name.
+        """
+        fields = params.get("fields")
+        if not fields:
+            return {"_id": 0}
+        # Repeated parameters arrive as a list
+        fields = ",".join(fields) if isinstance(fields, list) else fields
+        _, id_key = collections[entity]
+        names = {id_key}
+        for field in fields.split(","):
+            field = field.strip()
+            if not FIELD_NAME.fullmatch(field):
+                raise ValueError(f"Invalid field name '{field}'")
+            names.add(field)
+        projection = {"_id": 0}
+        # MongoDB rejects a path together with one of its sub paths, the parent already includes it
+        for name in sorted(names):
+            if not any(name.startswith(included + ".") for included in projection):
+                projection[name] = 1
+        return projection
+
+    def _status_flushed(self, statuses: dict, seconds: float):
+        # Cached documents loaded before the write miss the statuses which just left the buffer
+        self.invalidate("devices")
+        registry_metrics.observe_status_flush(len(statuses), seconds)
+        # Sent once written, with the statuses so that the clients apply them without reloading the devices
+        self.publish_change("devices", "status", list(statuses), statuses=statuses)
+
+    def _with_pending_status(self, entity: str, documents: list) -> list:
+        """Applies the buffered status updates, not written yet, to copies of the device documents"""
+        pending = self.status_buffer.snapshot() if entity == "devices" else None
+        if not pending:
+            return documents
+        return [self._overlay_status(document, pending) for document in documents]
+
+    @staticmethod
+    def _overlay_status(document: dict, pending: dict) -> dict:
+        entry = pending.get(document.get("deviceId"))
+        if entry is None:
+            return document
+        # Only the fields returned by the projection are replaced
+        document = dict(document)
+        status, last_updated = entry
+        for field, value in {"deviceStatus": status, "lastUpdated": last_updated, "lastModified": last_updated}.items():
+            if field in document:
+                document[field] = value
+        return document
+
+    def _list_response(self, entity: str, params: dict, query: dict = None, projection: dict = None):
+        """
+        Answers the list requests of an entity, optionally filtered by query.
+        Without since, limit, after or format parameters the whole list is served from the cache.
+        Pages and streams are read straight from the database to keep the memory bounded.
+        """
+        query = query or {}
+        projection = projection or self.defult_projection
+        if entity == "devices" and (params.get("since") or "deviceStatus" in query):
+            # These queries need the buffered statuses in the database, to see their lastUpdated and filter on them
+            self.status_buffer.flush()
+        if params.get("since"):
+            return self._changes_response(entity, params["since"], query, projection)
+
+        collection, id_key = collections[entity]
+        try:
+            limit = int(params["limit"]) if params.get("limit") else None
+            after = int(params["after"]) if params.get("after") else None
+            if limit is not None and limit <= 0:
+                raise ValueError(f"limit must be positive, not {limit}")
+        except (TypeError, ValueError):
+            # TypeError for a repeated parameter
+            return response_creator(False, message=f"Enter valid numbers, {entity}?limit={{count}}&after={{id}}", status=400)
+        if after is not None:
+            query = {**query, id_key: {"$gt": after}}
 
-    @cherrypy.tools.json_out()
+        if params.get("format") == "ndjson":
+            return self._stream_ndjson(entity, query, projection, limit)
+
+        self._check_etag(entity)
+        if limit is None and after is None:
+            # The $in conditions of repeated filters are lists, which cannot be hashed
+            key = (json.dumps(query, sort_keys=True), tuple(projection))
+            documents = self._cached(entity, key, lambda: list(collection.find(query, projection)))
+            return response_creator(True, content=self._with_pending_status(entity, documents), status=200)
+
+        # Served by the unique id index
+        cursor = collection.find(query, projection).sort(id_key, 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        documents = self._with_pending_status(entity, list(cursor))
+        response = response_creator(True, content=documents, status=200)
+        if limit and len(documents) == limit:
+            # Passed as after to get the next page
+            response["next"] = documents[-1][id_key]
+        return response
+
+    def _stream_ndjson(self, entity: str, query: dict, projection: dict, limit: int = None):
+        """Streams the documents as newline delimited JSON while the database cursor yields them"""
+        cherrypy.response.stream = True
+        cherrypy.response.headers["Content-Type"] = "application/x-ndjson"
+        collection, id_key = collections[entity]
+        cursor = collection.find(query, projection).sort(id_key, 1).batch_size(Config.STREAM_BATCH_SIZE)
+        if limit:
+            cursor = cursor.limit(limit)
+        pending = self.status_buffer.snapshot() if entity == "devices" else {}
+
+        def generate():
+            try:
+                for document in cursor:
+                    yield dumps(self._overlay_status(document, pending)) + b"\n"
+            finally:
+                cursor.close()
+        return generate()
+
+    def _watch(self, entity: str, params: dict):
+        """
+        Answers /{entity}/watch. As a long poll, it returns once the entity's version differs from the
+        version parameter or after timeout seconds. With format=sse, or an Accept of text/event-stream,
+        it streams an event on each change. Clients then fetch what changed with ?since=.
+        """
+        try:
+            version = int(params["version"]) if params.get("version") else None
+            timeout = min(float(params.get("timeout", Config.WATCH_TIMEOUT)), Config.WATCH_TIMEOUT)
+        except (TypeError, ValueError):
+            return response_creator(False, message=f"Enter valid numbers, {entity}/watch?version={{version}}&timeout={{seconds}}", status=400)
+        # Versions restart with the registry, any version of another run is outdated
+        if params.get("epoch") and params["epoch"] != str(self.epoch):
+            version = None
+        sse = params.get("format") == "sse" or "text/event-stream" in cherrypy.request.headers.get("Accept", "")
+        if sse and version is None:
+            # Sent back by the browsers when they reconnect
+            epoch, _, last_version = cherrypy.request.headers.get("Last-Event-ID", "").partition("-")
+            version = int(last_version) if epoch == str(self.epoch) and last_version.isdigit() else None
+
+        if not self.watchers.acquire(blocking=False):
+            cherrypy.response.status = 503
+            return response_creator(False, message="Too many watch requests, retry later", status=503)
+        if sse:
+            # Released when the request ends, also if the stream is never read, as for HEAD requests
+            cherrypy.request.hooks.attach("on_end_request", self.watchers.release)
+            return self._stream_changes(entity, version)
+        try:
+            # Without a version, the current one is returned at once
+            current = self.wait_for_change(entity, version, timeout) if version is not None else self.versions[entity]
+        finally:
+            self.watchers.release()
+        return response_creator(True, content={
+            "entity": entity, "version": current, "epoch": self.epoch, "changed": current != version
+        }, status=200)
+
+    def _stream_changes(self, entity: str, version: int = None):
+        """Streams a Server-Sent Event on each version change of the entity, with keep alive comments in between"""
+        cherrypy.response.stream = True
+        cherrypy.response.headers["Content-Type"] = "text/event-stream"
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+
+        def generate():
+            # Versions start at 0, so an unknown version gets the current one at once
+            current = version if version is not None else -1
+            deadline = time.monotonic() + Config.SSE_MAX_DURATION
+            while time.monotonic() < deadline:
+                latest = self.wait_for_change(entity, current, min(Config.WATCH_TIMEOUT, deadline - time.monotonic()))
+                if latest == current:
+                    yield b": keep alive\n\n"
+                    continue
+                current = latest
+                event = dumps({"entity": entity, "version": current, "epoch": self.epoch})
+                yield f"id: {self.epoch}-{current}\nevent: change\ndata: ".encode("utf-8") + event + b"\n\n"
+        return generate()
+
+    def _changes_response(self, entity: str, since: str, query: dict = None, projection: dict = None):
+        try:
+            since = datetime.datetime.strptime(since, TIME_FORMAT)
+        except (TypeError, ValueError):
+            return response_creator(False, message=f"Enter a valid time, {entity}?since=YYYY-MM-DD HH:MM:SS", status=400)
+        return response_creator(True, content=self.get_changes(entity, since, query, projection), status=200)
+
+    @cherrypy.tools.json_out(handler=json_handler)
+    @measured
     def GET(self, *uri, **params):
         """
         Handles GET requests for various resources:
         - /broker: Returns MQTT broker details
+        - /db_metrics: Returns the MongoDB command latencies and connection pool usage
+        - /bootstrap?plantId={id}: Returns the broker, the main topic and optionally the plants with their devices
         - /devices or /device/{id}: Returns all devices or specific device
+          /devices accepts the plantId, deviceType, measureType and deviceStatus filters
+        - /devices, /plants or /users?since=YYYY-MM-DD HH:MM:SS: Returns the changes and deletions since then
+        - /devices, /plants or /users?limit={n}&after={id}: Returns a page sorted by id, with the next cursor
+        - /devices, /plants or /users?format=ndjson: Streams the documents, one JSON per line
+        - /devices, /plants or /users/watch?version={v}: Waits for a change, add format=sse to stream them
+        - Every devices, plants and users request accepts fields=a,b.c to return only those fields
         - /plants or /plant/{id}: Returns all plants or specific plant
         - /users or /user/{id}: Returns all users or specific user
         """
@@ -96,55 +787,90 @@ class Catalog():
         else:
             end_point = uri[0].lower()
 
+            if end_point in collections and len(uri) > 1 and uri[1] == "watch":
+                return self._watch(end_point, params)
+
             if end_point == "broker":
-                self.get_broker()
-                return response_creator(True, content=self.broker, status=200)
+                self._check_etag("general")
+                return response_creator(True, content=self.get_broker(), status=200)
+
+            elif end_point == "db_metrics":
+                return response_creator(True, content=get_metrics(), status=200)
+
+            elif end_point == "bootstrap":
+                plant_ids = params.get("plantId", [])
+                # Repeated parameters arrive as a list
+                plant_ids = plant_ids if isinstance(plant_ids, list) else [plant_ids]
+                try:
+                    plant_ids = [int(plant_id) for plant_id in plant_ids]
+                except ValueError:
+                    return response_creator(False, message="Enter valid plant ids, bootstrap?plantId={plant id}", status=400)
+                return response_creator(True, content=self.get_bootstrap(plant_ids), status=200)
 
             elif end_point == "devices":
+                try:
+                    projection = self.projection("devices", params)
+                except ValueError as e:
+                    return response_creator(False, message=f"{e}, devices?fields={{field}},{{field}}", status=400)
                 if len(uri) > 1:
                     try:
-                        device_Id = int(uri[1])
-                        for device in self.get_all_devices():
-                            if str(device.get("deviceId")) == device_Id:
-                                return response_creator(True, content=[device], status=200)
-                        return response_creator(False, message="device not present", status=404)
-                    except:
+                        device_id = int(uri[1])
+                    except ValueError:
                         return response_creator(False, message="Enter a valid device id, device/{device id}", status=404)
-                else:   
-                    return response_creator(True, content=self.get_all_devices(), status=200)
+                    self._check_etag("devices")
+                    device = self._cached("devices", (device_id, tuple(projection)), lambda: self.get_device(device_id, projection))
+                    if device:
+                        return response_creator(True, content=self._with_pending_status("devices", [device]), status=200)
+                    return response_creator(False, message="device not present", status=404)
+                else:
+                    try:
+                        query = self.device_query(params)
+                    except ValueError:
+                        return response_creator(False, message="Enter a valid plant id, devices?plantId={plant id}", status=400)
+                    return self._list_response("devices", params, query, projection)
 
                     
 
             elif end_point == "plants":
+                try:
+                    projection = self.projection("plants", params)
+                except ValueError as e:
+                    return response_creator(False, message=f"{e}, plants?fields={{field}},{{field}}", status=400)
                 if len(uri) > 1:
                     try:
                         plant_id = int(uri[1])
-                        for plant in self.get_all_plants():
-                            if plant.get("plantId") == plant_id:
-                                return response_creator(True, content=[plant], status=200)
-                        return response_creator(False, message="plant not present", status=404)
-                    except:
+                    except ValueError:
                         return response_creator(False, message="Enter a valid plant id, plant/{plant id}", status=404)
-                else:   
-                    return response_creator(True, content=self.get_all_plants(), status=200)
+                    self._check_etag("plants")
+                    plant = self._cached("plants", (plant_id, tuple(projection)), lambda: self.get_plant(plant_id, projection))
+                    if plant:
+                        return response_creator(True, content=[plant], status=200)
+                    return response_creator(False, message="plant not present", status=404)
+                else:
+                    return self._list_response("plants", params, projection=projection)
 
             
             elif end_point == "main_topic":
-                self.get_main_topic()
-                return response_creator(True, content=self.main_topic, status=200)
+                self._check_etag("general")
+                return response_creator(True, content=self.get_main_topic(), status=200)
 
             elif end_point == "users":
+                try:
+                    projection = self.projection("users", params)
+                except ValueError as e:
+                    return response_creator(False, message=f"{e}, users?fields={{field}},{{field}}", status=400)
                 if len(uri) > 1:
                     try:
                         user_id = int(uri[1])
-                        for user in self.get_all_users():
-                            if user.get("userId") == user_id:
-                                return response_creator(True, content=[user], status=200)
-                        return response_creator(False, message="user not present", status=404)
-                    except:
+                    except ValueError:
                         return response_creator(False, message="Enter a valid user id, user/{user id}", status=404)
-                else:   
-                    return response_creator(True, content=self.get_all_users(), status=200)
+                    self._check_etag("users")
+                    user = self._cached("users", (user_id, tuple(projection)), lambda: self.get_user(user_id, projection))
+                    if user:
+                        return response_creator(True, content=[user], status=200)
+                    return response_creator(False, message="user not present", status=404)
+                else:
+                    return self._list_response("users", params, projection=projection)
 
             else:
                 return response_creator(False, message="No valid url. Enter a valid url among: broker, devices, device/{id}, plants, plant/{plantId}, users, user/{userId}", status=404)
@@ -154,67 +880,41 @@ class Catalog():
 
 
 
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=json_handler)
     @cherrypy.tools.json_in()
+    @measured
     def POST(self, *uri, **params):
         if len(uri) == 0:
             return response_creator(False, message="Specify what to add: /plants, /devices, /users", status=404)
         else:
             end_point = uri[0].lower()
-            data = cherrypy.request.json
-            data["lastUpdated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # Batch registration, /plants/batch or /devices/batch with a list of items
+            if len(uri) > 1 and uri[1] == "batch" and end_point in ["plants", "devices"]:
+                return self._register_batch(end_point, cherrypy.request.json)
+            # Reloads the broker and main topic after a change in the general collection
+            if len(uri) > 1 and uri[1] == "reload" and end_point == "general":
+                self.reload_general()
+                return response_creator(True, content=self.get_bootstrap(), message="General config reloaded", status=200)
 
-            # Supposed to get a plant dictionary
-            if end_point == "plants":
-                if plants_collection.find_one({"plantId": data["plantId"]}):
-                    print(f"Plant {data['plantId']} already exists")
-
-                try:
-                    plant = Plant(**data)
-                    return plant.save_to_db()
-                except ValueError as ve:
-                    cherrypy.response.status = 400
-                    return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
-                except PyMongoError as pe:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
-                except Exception as e:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
-                    
-            elif end_point == "devices":
-                try:
-                    device = Device(**data)
-                    return device.save_to_db()
-                except ValueError as ve:
-                    cherrypy.response.status = 400
-                    return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
-
-            elif end_point == "users":
-                if users_collection.find_one({"userId": data["userId"]}):
-                    print(f"User {data['userId']} already exists")
+            data = cherrypy.request.json
+            data["lastUpdated"] = datetime.datetime.now().replace(microsecond=0)
 
-                try:
-                    user = User(**data)
-                    return user.save_to_db()
-                except ValueError as ve:
-                    cherrypy.response.status = 400
-                    return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
-                except PyMongoError as pe:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
-                except Exception as e:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
+            if end_point in ["plants", "devices", "users"]:
+                return self._register(end_point, data)
+            else:
+                return response_creator(False, message="No valid url. Enter a valid url among: plants, devices, users", status=404)
 
 
 
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=json_handler)
     @cherrypy.tools.json_in()
+    @measured
     def PUT(self, *uri, **params):
         """
         Handles PUT requests to update existing resources:
         - /devices/status: Updates device online/offline status
+        - /plants/batch, /devices/batch: Registers a list of plants or devices at once
+        - /devices/heartbeat: Refreshes the lastUpdated of a list of device ids
         - /plants: Updates plant information (creates if doesn't exist)
         - /devices: Updates device information (creates if doesn't exist)
         - /users: Updates user information (creates if doesn't exist)
@@ -223,99 +923,291 @@ class Catalog():
             return response_creator(False, message="Specify what to update: /plants, /devices, /users", status=404)
         else:
             end_point = uri[0].lower()
+            # Batch registration, /plants/batch or /devices/batch with a list of items
+            if len(uri) > 1 and uri[1] == "batch" and end_point in ["plants", "devices"]:
+                return self._register_batch(end_point, cherrypy.request.json)
+            # Keep-alive of already registered devices, with a list of device ids
+            if len(uri) > 1 and uri[1] == "heartbeat" and end_point == "devices":
+                return self.heartbeat(cherrypy.request.json)
+
             data = cherrypy.request.json
-            data["lastUpdated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            data["lastUpdated"] = datetime.datetime.now().replace(microsecond=0)
 
             print(f"Data to be updated: {data}")
 
-            # Supposed to get a plant dictionary
-            if end_point == "plants":
-                db_response = plants_collection.find_one({"plantId": data["plantId"]})
-                if not db_response:
-                    print(f"Plant {data['plantId']} does not exists, it will be inserted...")
-
-                try:
-                    plant = Plant(**data)
-                    return plant.save_to_db()
-                except ValueError as ve:
-                    cherrypy.response.status = 400
-                    return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
-                except PyMongoError as pe:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
-                except Exception as e:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
+            if end_point in ["plants", "users"]:
+                return self._register(end_point, data)
 
 
             elif end_point == "devices":
                 if len(uri) > 1:
                     if uri[1] == "status":
                         device_id, new_status = data.get("deviceId"), data.get("status")
-                        try:
-                            # Update device status using upsert
-                            result = devices_collection.update_one(
-                                {"deviceId": device_id},
-                                {"$set": {
-                                    "deviceStatus": new_status,
-                                    "lastUpdated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                }},
-                                upsert=True
-                            )
-                            if result.modified_count > 0 or result.upserted_id:
-                                print(f"Device {device_id} status updated to {new_status}")
-                                return response_creator(True, message="Device status updated successfully", status=200)
-                            print(f"Device {device_id} status not updated")
-                            return response_creator(False, message="Failed to update device status", status=500)
-                        except PyMongoError as pe:
-                            cherrypy.response.status = 500
-                            print(f"DatabaseError: {str(pe)}")
-                            return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
-                        except Exception as e:
-                            cherrypy.response.status = 500
-                            print(f"UnknownError: {str(e)}")
-                            return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
+                        if device_id is None or new_status is None:
+                            cherrypy.response.status = 400
+                            return response_creator(False, message="Send the deviceId and the status", status=400)
+                        self.update_status(device_id, new_status)
+                        return response_creator(True, message="Device status updated successfully", status=200)
                         
                 else:
-                    # Check if the device already exists
-                    db_response = devices_collection.find_one({"deviceId": data["deviceId"]})
-                    if db_response:
-                        print(f"Device {data['deviceId']} already exists")
+                    return self._register(end_point, data)
 
-                    try:
-                        device = Device(**data)
-                        return device.save_to_db()
-                    except ValueError as ve:
-                        cherrypy.response.status = 400
-                        return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
-                    except PyMongoError as pe:
-                        cherrypy.response.status = 500
-                        return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
-                    except Exception as e:
-                        cherrypy.response.status = 500
-                        return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
+            else:
+                return response_creator(False, message="No valid url. Enter a valid url among: broker, devices, device/{id}, plants, plant/{plantId}, users, user/{userId}", status=404)
 
 
-            elif end_point == "users":
-                db_response = users_collection.find_one({"userId": data["userId"]})
-                if not db_response:
-                    print(f"User {data['userId']} does not exist, it will be inserted...")
 
-                try:
-                    user = User(**data)
-                    return user.save_to_db()
-                except ValueError as ve:
-                    cherrypy.response.status = 400
-                    return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
-                except PyMongoError as pe:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
-                except Exception as e:
-                    cherrypy.response.status = 500
-                    return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
+    def heartbeat(self, device_ids: list):
+        """
+        Refreshes lastUpdated of the listed devices and of the plants hosting them with
+        one update_many each, without re-validating the devices.
+        Fails with 404 if some devices are unknown, so the caller registers them again.
+        """
+        try:
+            device_ids = [int(device_id) for device_id in device_ids]
+        except (TypeError, ValueError):
+            cherrypy.response.status = 400
+            return response_creator(False, message="Send a list of device ids, [deviceId, ...]", status=400)
+
+        try:
+            refreshed = self._touch("devices", device_ids)
+        except PyMongoError as pe:
+            cherrypy.response.status = 500
+            return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
+
+        if refreshed < len(set(device_ids)):
+            missing = len(set(device_ids)) - refreshed
+            print(f"Heartbeat for {missing} unknown devices")
+            cherrypy.response.status = 404
+            return response_creator(False, content={"refreshed": refreshed},
+                                    message=f"{missing} devices are not registered", status=404)
+        return response_creator(True, content={"refreshed": refreshed},
+                                message="Devices refreshed successfully", status=200)
+
 
+    def update_status(self, device_id: int, status: str):
+        """Records a status received over HTTP or MQTT"""
+        # Written with the other buffered updates, the reads see it right away
+        self.status_buffer.put(device_id, status)
+        registry_metrics.observe_status_update()
+        self.invalidate("devices")
+        # The next registration of the device has to overwrite the status again
+        self._forget("devices", device_id)
+        print(f"Device {device_id} status updated to {status}")
+
+
+    def set_presence(self, device_ids: list, online: bool):
+        """
+        Marks the devices of a connector online or offline. The online devices are kept alive by the cleanup
+        without heartbeats, the offline ones expire after CLEANUP_THRESHOLD as before.
+        The connectors repeat their online message, presenceAt records the last one.
+        """
+        try:
+            # Only the devices whose presence changes are modified
+            result = devices_collection.update_many(
+                {"deviceId": {"$in": device_ids}, "online": {"$ne": online}},
+                {"$set": {"online": online, "lastModified": datetime.datetime.now().replace(microsecond=0)}}
+            )
+            if online:
+                found = self._touch("devices", device_ids, {"presenceAt": datetime.datetime.now().replace(microsecond=0)})
             else:
-                return response_creator(False, message="No valid url. Enter a valid url among: broker, devices, device/{id}, plants, plant/{plantId}, users, user/{userId}", status=404)
+                found = devices_collection.count_documents({"deviceId": {"$in": device_ids}})
+        except PyMongoError as e:
+            print(f"Failed to record the presence of devices {device_ids}: {e}")
+            return
+        if found < len(set(device_ids)):
+            print(f"Presence received for {len(set(device_ids)) - found} unregistered devices")
+        print(f"Devices {device_ids} are {'online' if online else 'offline'}")
+        if result.modified_count:
+            self.invalidate("devices")
+            self.publish_change("devices", "presence", device_ids)
+
+
+    def notify(self, topic: str, payload):
+        """
+        Handles the MQTT messages of the device connectors:
+        - {mainTopic}/catalog/presence/{connector}: {"status": "online" or "offline", "deviceIds": [...]},
+          retained, with the offline one registered as the connector's Last Will
+        - {mainTopic}/catalog/status/{deviceId}: {"status": ...}
+        and the change events of the other replicas, on {mainTopic}/catalog/changes
+        """
+        try:
+            message = json.loads(payload)
+            prefix, _, last_level = topic.rpartition("/")
+            if topic == f"{self.main_topic}/{Config.CHANGES_TOPIC}":
+                self.apply_change(message)
+            elif prefix == f"{self.main_topic}/{Config.PRESENCE_TOPIC}":
+                self.set_presence([int(device_id) for device_id in message["deviceIds"]], message["status"] == "online")
+            elif prefix == f"{self.main_topic}/{Config.STATUS_TOPIC}":
+                self.update_status(int(last_level), message["status"])
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Unrecognized message received on {topic}: {e}")
+
+
+    def start_ingestion(self):
+        """Subscribes to the presence and status topics, once the change events client is connected"""
+        if self.mqtt_client is None or not self.main_topic:
+            print("Presence ingestion disabled, not connected to the broker.")
+            return
+        self.mqtt_client.mySubscribe(f"{self.main_topic}/{Config.PRESENCE_TOPIC}/+")
+        self.mqtt_client.mySubscribe(f"{self.main_topic}/{Config.STATUS_TOPIC}/+")
+
+
+    def _touch(self, entity: str, ids: list, fields: dict = None) -> int:
+        """
+        Refreshes lastUpdated of the ids, and of the plants hosting them for devices.
+        fields are set on the ids' documents in the same update. Returns the number of entries found.
+        The cached reads are dropped too, here and on the other replicas, they would keep serving the old lastUpdated.
+        """
+        collection, id_key = collections[entity]
+        now = datetime.datetime.now().replace(microsecond=0)
+        result = collection.update_many({id_key: {"$in": ids}}, {"$set": {"lastUpdated": now, **(fields or {})}})
+        if entity == "devices":
+            plants_collection.update_many({"deviceInventory": {"$in": ids}}, {"$set": {"lastUpdated": now}})
+        if result.matched_count:
+            self.invalidate(*(("devices", "plants") if entity == "devices" else (entity,)))
+            self.publish_change(entity, "touch", ids)
+        return result.matched_count
+
+
+    def _hash_key(self, entity: str, data: dict):
+        _, id_key = collections[entity]
+        try:
+            return (entity, int(data.get(id_key)))
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+
+    def _is_unchanged(self, entity: str, data: dict) -> bool:
+        key = self._hash_key(entity, data)
+        return key is not None and self.content_hashes.get(key) == content_hash(data)
+
+
+    def _remember(self, entity: str, data: dict):
+        key = self._hash_key(entity, data)
+        if key is not None:
+            self.content_hashes[key] = content_hash(data)
+
+
+    def _forget(self, entity: str, item_id):
+        try:
+            self.content_hashes.pop((entity, int(item_id)), None)
+        except (TypeError, ValueError):
+            pass
+
+
+    def _register(self, entity: str, data: dict):
+        """
+        Validates and saves a single plant, device or user.
+        If the payload equals the last one saved, only its timestamps are refreshed.
+        """
+        model = entity_models[entity]
+        if self._is_unchanged(entity, data):
+            key = self._hash_key(entity, data)
+            try:
+                if self._touch(entity, [key[1]]):
+                    print(f"{model.__name__} {key[1]} unchanged, lastUpdated refreshed")
+                    return response_creator(True, message=f"{model.__name__} registered successfully", status=200)
+            except PyMongoError as pe:
+                print(f"DatabaseError: {str(pe)}")
+            # The entry is gone, it is saved again in full
+            self._forget(entity, key[1])
+
+        try:
+            item = model(**data)
+            if entity == "devices":
+                # The registered status replaces any status update not written yet
+                self.status_buffer.discard([item.device_id])
+            response = item.save_to_db()
+        except ValueError as ve:
+            cherrypy.response.status = 400
+            return response_creator(False, message=f"ValueError: {str(ve)}", status=400)
+        except PyMongoError as pe:
+            cherrypy.response.status = 500
+            return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
+        except Exception as e:
+            cherrypy.response.status = 500
+            return response_creator(False, message=f"UnknownError: {str(e)}", status=500)
+
+        if entity == "devices":
+            # Saving a device also updates its plant's inventory
+            self.invalidate("devices", "plants")
+        else:
+            self.invalidate(entity)
+        if response.get("success"):
+            self._remember(entity, data)
+            self.publish_change(entity, "upsert", [self._hash_key(entity, data)[1]])
+        return response
+
+
+    def _register_batch(self, end_point: str, items: list):
+        """
+        Validates a list of plants or devices in one pass and saves the valid ones with bulk writes.
+        Items equal to the last saved ones only get their timestamps refreshed.
+        The response content reports the registered ids and the reason of each failure.
+        """
+        if not isinstance(items, list):
+            cherrypy.response.status = 400
+            return response_creator(False, message=f"Send a list of {end_point} to register in batch", status=400)
+
+        model = entity_models[end_point]
+        _, id_key = collections[end_point]
+
+        unchanged = [self._hash_key(end_point, item)[1] for item in items
+                     if isinstance(item, dict) and self._is_unchanged(end_point, item)]
+        try:
+            if unchanged and self._touch(end_point, unchanged) < len(set(unchanged)):
+                # Some of them are gone, all are saved again in full
+                unchanged = []
+        except PyMongoError as pe:
+            print(f"DatabaseError: {str(pe)}")
+            unchanged = []
+
+        valid, failed, changed = [], {}, {}
+        for item in items:
+            key = self._hash_key(end_point, item) if isinstance(item, dict) else None
+            if key is not None and key[1] in unchanged:
+                continue
+            try:
+                valid_item = model(**item)
+            except (ValueError, TypeError) as ve:
+                item_id = item.get(id_key) if isinstance(item, dict) else None
+                failed[str(item_id)] = f"ValueError: {str(ve)}"
+                continue
+            valid.append(valid_item)
+            changed[key[1]] = item
+
+        if not valid:
+            response = response_creator(
+                not failed,
+                content={"registered": [], "failed": failed},
+                message=f"{len(unchanged)} {end_point} unchanged",
+                status=200 if unchanged or not failed else 400
+            )
+        else:
+            try:
+                if end_point == "devices":
+                    # The registered statuses replace the status updates not written yet
+                    self.status_buffer.discard([device.device_id for device in valid])
+                response = model.save_many_to_db(valid, failed)
+            except PyMongoError as pe:
+                cherrypy.response.status = 500
+                return response_creator(False, message=f"DatabaseError: {str(pe)}", status=500)
+
+            if end_point == "devices":
+                # Saving devices also updates their plants' inventory
+                self.invalidate("devices", "plants")
+            else:
+                self.invalidate("plants")
+
+        for item_id in response.get("content", {}).get("registered", []):
+            self._remember(end_point, changed[item_id])
+        # The unchanged items only had their timestamps refreshed
+        self.publish_change(end_point, "upsert", response.get("content", {}).get("registered", []))
+        if "content" in response:
+            response["content"]["registered"] += unchanged
+        cherrypy.response.status = response["status"]
+        return response
 
 
 
@@ -325,56 +1217,173 @@ class Catalog():
         updated within the configured threshold time (indicating they're offline/inactive)
         """
         print("Cleaning up outdated Plants and Devices...")
-        self._cleanup_plants()
-        self._cleanup_devices()
+        start = time.perf_counter()
+        deleted = {"plants": [], "devices": []}
+        failed = False
+        # The buffered status updates refresh lastUpdated, so they are written before looking for stale devices
+        self.status_buffer.flush()
+        try:
+            # Devices reporting their presence over MQTT need no heartbeat while they are online. Only a recent
+            # presence counts, a missed Last Will must not keep the devices of a vanished connector forever
+            a_threshold_ago = datetime.datetime.now() - datetime.timedelta(minutes=self.threshold)
+            online = devices_collection.distinct("deviceId", {"online": True, "presenceAt": {"$gte": a_threshold_ago}})
+            if online:
+                self._touch("devices", online)
+            deleted["plants"] = self._cleanup_plants()
+            deleted["devices"] = self._cleanup_devices()
+        except PyMongoError as e:
+            print(f"An error occurred during the clean up: {e}")
+            failed = True
+        # After a failure, part of the entries might have been deleted anyway
+        if deleted["plants"] or deleted["devices"] or failed:
+            self.invalidate("plants", "devices")
+        for entity, ids in deleted.items():
+            self.publish_change(entity, "delete", ids)
+        registry_metrics.observe_cleanup(time.perf_counter() - start, len(deleted["plants"]), len(deleted["devices"]), failed)
         print("Clean up completed.")
 
     
-    # Removes outdated plants
+    # Deletes the documents not updated since a_threshold_ago, returns the deleted ids
+    def _delete_stale(self, entity: str, a_threshold_ago: datetime.datetime) -> list:
+        collection, id_key = collections[entity]
+        stale = {"lastUpdated": {"$lt": a_threshold_ago}}
+        # Covered by the (lastUpdated, id) index
+        ids = [document[id_key] for document in collection.find(stale, {"_id": 0, id_key: 1})]
+        if not ids:
+            return []
+
+        result = collection.delete_many({**stale, id_key: {"$in": ids}})
+        if result.deleted_count < len(ids):
+            # Some entries were refreshed in the meantime and were not deleted
+            alive = set(collection.distinct(id_key, {id_key: {"$in": ids}}))
+            ids = [item_id for item_id in ids if item_id not in alive]
+        self._add_tombstones(entity, ids)
+        for item_id in ids:
+            self._forget(entity, item_id)
+        return ids
+
+
+    # Removes outdated plants, returns the deleted ids
     def _cleanup_plants(self):
         a_threshold_ago = datetime.datetime.now() - datetime.timedelta(minutes=self.threshold)
-        plants = self.get_all_plants()
+        plant_ids = self._delete_stale("plants", a_threshold_ago)
+        if plant_ids:
+            print(f"Plants {plant_ids} deleted")
+            # A re-created plant starts with an empty inventory, so its devices have to be saved in full
+            self.content_hashes = {key: value for key, value in self.content_hashes.items() if key[0] != "devices"}
+        return plant_ids
 
-        for plant in plants:
-            last_updated = datetime.datetime.strptime(plant['lastUpdated'], "%Y-%m-%d %H:%M:%S")
-            if last_updated < a_threshold_ago:
-                self.delete_plant(plant['plantId'])
-                print(f"Plant {plant['plantId']} deleted")
 
-
-    # Removes outdated devices
+    # Removes outdated devices and pulls them out of their plants' inventory, returns the deleted ids
     def _cleanup_devices(self):
         a_threshold_ago = datetime.datetime.now() - datetime.timedelta(minutes=self.threshold)
-        devices = self.get_all_devices()
+        device_ids = self._delete_stale("devices", a_threshold_ago)
+        if not device_ids:
+            return []
+
+        # lastUpdated is left untouched so that the plants are not kept alive by the pull,
+        # lastModified moves so that the delta queries report the new inventory
+        plants_collection.update_many(
+            {"deviceInventory": {"$in": device_ids}},
+            {
+                "$pull": {"deviceInventory": {"$in": device_ids}},
+                "$set": {"lastModified": datetime.datetime.now().replace(microsecond=0)}
+            }
+        )
+        print(f"Devices {device_ids} deleted")
+        return device_ids
+
+class Metrics():
+    """Exposes the registry metrics in the Prometheus text format on /metrics"""
+    exposed = True
+
+    def GET(self):
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return registry_metrics.render(get_metrics())
+
+
+
+def bench_thundering_herd(catalog: Catalog, clients: int = 200):
+    """Clients reading the same device list right after a write, run with python registry.py --bench"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def herd(read):
+        queries = [0]
+        def loader():
+            queries[0] += 1
+            return catalog.get_all_devices()
+        catalog.invalidate("devices")
+        barrier = threading.Barrier(clients)
+        def client():
+            barrier.wait()
+            return read(loader)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(lambda _: client(), range(clients)))
+        return time.perf_counter() - start, queries[0]
+
+    for name, read in [("uncoalesced", lambda loader: loader()),
+                       ("coalesced", lambda loader: catalog._cached("devices", "bench", loader))]:
+        elapsed, queries = herd(read)
+        print(f"{name}: {clients} concurrent reads in {elapsed * 1000:.1f} ms with {queries} database queries")
 
-        for device in devices:
-            last_updated = datetime.datetime.strptime(device['lastUpdated'], "%Y-%m-%d %H:%M:%S")
-            if last_updated < a_threshold_ago:
-                self.delete_device(device['deviceId'])
-                print(f"Device {device['deviceId']} deleted")
 
 if __name__ == "__main__":
     # Configure CherryPy to handle RESTful requests
     conf = {"/": {
         'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
-        'tools.sessions.on': True
+        'tools.sessions.on': True,
+        'tools.compress.on': True,
+        'tools.compress.min_size': Config.COMPRESSION_MIN_SIZE,
+        'tools.compress.compress_level': Config.COMPRESSION_LEVEL,
     }}
     
+    if Config.STORAGE_ENGINE == "memory":
+        # Nothing is kept between runs, so the broker and main topic are written at each start
+        import mongo_setup
+        mongo_setup.setup()
+
+    if "--bench" in sys.argv[1:]:
+        catalog = Catalog()
+        bench_thundering_herd(catalog)
+        catalog.status_buffer.stop()
+        sys.exit()
+
     # Start the web service and periodic cleanup task
     web_service = Catalog()
     cherrypy.tree.mount(web_service, '/', conf)
+    cherrypy.tree.mount(Metrics(), '/metrics', conf)
+    # The watch requests hold a worker thread each
+    cherrypy.config.update({"server.thread_pool": Config.SERVER_THREAD_POOL})
     cherrypy.engine.start()
+    web_service.start_change_events()
+    if Config.PRESENCE_INGESTION:
+        web_service.start_ingestion()
 
-    # Run cleanup check every CLEANUP_INTERVAL seconds
+    # Every replica serves the requests, the one holding the lease also runs the cleanup every CLEANUP_INTERVAL seconds
+    cleanup_lease = Lease(leases_collection, "cleanup", Config.CLEANUP_LEASE_TTL)
     counter = 0
     try:
         while True:
             if counter % Config.CLEANUP_INTERVAL == 0:
-                web_service.cleanup()
+                # Picks up the changes made directly on the general collection
+                web_service.reload_general()
+            if not web_service.events_connected and counter % Config.CACHE_TTL == 0:
+                # The writes of the other replicas go unnoticed, the cached reads are kept at most CACHE_TTL seconds
+                web_service.drop_caches()
+            if counter % Config.CLEANUP_LEASE_RENEW == 0 and cleanup_lease.acquire():
+                # The last run may come from the replica which held the lease before
+                if cleanup_lease.due(Config.CLEANUP_INTERVAL):
+                    web_service.cleanup()
+                    cleanup_lease.record_run()
             counter += 1
             time.sleep(1)
     except KeyboardInterrupt:
         print("Keyboard interrupt detected. Shutting down...")
+        web_service.status_buffer.stop()
+        cleanup_lease.release()
+        if web_service.mqtt_client:
+            web_service.mqtt_client.stop()
         cherrypy.engine.stop()
 
 
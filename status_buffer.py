@@ -0,0 +1,105 @@
+'''Write-behind buffer of the device status updates'''
+import threading
+import time
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+
+class StatusBuffer:
+    """
+    Keeps the latest status of each device and writes them all with one bulk write,
+    flush_interval seconds after the first update or as soon as max_entries devices are waiting.
+    on_flush is called with the written statuses by device id and the duration of the write.
+    """
+    def __init__(self, collection, flush_interval: float, max_entries: int, on_flush=None):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.on_flush = on_flush
+        # device id -> (status, lastUpdated), kept until written
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Only one bulk write at a time, from the flusher thread or a synchronous flush
+        self.flush_lock = threading.Lock()
+        self.has_entries = threading.Event()
+        self.full = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="status-buffer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the flusher thread and writes what is left"""
+        self.stopped.set()
+        self.has_entries.set()
+        self.full.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    def put(self, device_id: int, status: str):
+        with self.lock:
+            self.pending[device_id] = (status, datetime.now().replace(microsecond=0))
+            full = len(self.pending) >= self.max_entries
+        self.has_entries.set()
+        if full:
+            self.full.set()
+
+    def discard(self, device_ids: list):
+        """
+        Drops the pending updates of devices about to be saved in full or deleted.
+        Waits for a flush in progress, which could otherwise write an older status over the full save.
+        """
+        with self.flush_lock, self.lock:
+            for device_id in device_ids:
+                self.pending.pop(device_id, None)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.pending)
+
+    def flush(self) -> bool:
+        """Writes the pending updates, returns False if the write failed and they are kept for the next one"""
+        with self.flush_lock:
+            batch = self.snapshot()
+            if not batch:
+                return True
+            start = time.perf_counter()
+            try:
+                self.collection.bulk_write([
+                    UpdateOne(
+                        {"deviceId": device_id},
+                        {"$set": {"deviceStatus": status, "lastUpdated": last_updated, "lastModified": last_updated}},
+                        upsert=True
+                    )
+                    for device_id, (status, last_updated) in batch.items()
+                ], ordered=False)
+            except PyMongoError as e:
+                print(f"Failed to write {len(batch)} device statuses: {e}")
+                return False
+
+            with self.lock:
+                for device_id, entry in batch.items():
+                    # Updates received during the write stay for the next one
+                    if self.pending.get(device_id) == entry:
+                        del self.pending[device_id]
+            if self.on_flush:
+                self.on_flush({device_id: status for device_id, (status, _) in batch.items()}, time.perf_counter() - start)
+            return True
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.has_entries.wait()
+            # Gathers the updates arriving within the interval, unless the buffer fills up first
+            self.full.wait(self.flush_interval)
+            self.has_entries.clear()
+            self.full.clear()
+            if not self.flush():
+                # Retried after a pause while the database is unavailable
+                self.stopped.wait(1)
+            with self.lock:
+                if self.pending:
+                    self.has_entries.set()
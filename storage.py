@@ -0,0 +1,555 @@
+'''
+In-memory and SQLite storage engines of the registry.
+Both implement the part of the pymongo collection API used by the catalog and the models,
+so the same code runs on MongoDB, on a zero-latency store for load tests or on a single SQLite file.
+'''
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne, UpdateMany, DeleteOne, DeleteMany, InsertOne
+from pymongo import errors
+
+
+class StorageError(errors.PyMongoError):
+    """Raised by the memory and SQLite engines, so that it is handled like the MongoDB errors"""
+
+
+class DuplicateKeyError(StorageError, errors.DuplicateKeyError):
+    pass
+
+
+class WriteResult:
+    """Result of a write, with the attributes of the pymongo results the registry reads"""
+    def __init__(self, matched_count: int = 0, modified_count: int = 0, upserted_id=None,
+                 deleted_count: int = 0, inserted_ids: list = None):
+        self.acknowledged = True
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+        self.deleted_count = deleted_count
+        self.inserted_ids = inserted_ids or []
+
+
+### Query, projection and update evaluation on plain documents
+def _clone(value):
+    """Copies a document, faster than deepcopy for JSON like values"""
+    if isinstance(value, dict):
+        return {key: _clone(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_clone(item) for item in value]
+    return value
+
+
+def _values(document: dict, path: str) -> list:
+    """Values found at a dotted path, looking into arrays of documents. Arrays also match by their elements."""
+    values = [document]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                found.append(value[part])
+            elif isinstance(value, list):
+                found += [item[part] for item in value if isinstance(item, dict) and part in item]
+        values = found
+    return values + [item for value in values if isinstance(value, list) for item in value]
+
+
+def _compare(values: list, operator: str, argument) -> bool:
+    for value in values:
+        try:
+            if operator == "$gt" and value > argument or operator == "$gte" and value >= argument \
+                    or operator == "$lt" and value < argument or operator == "$lte" and value <= argument:
+                return True
+        except TypeError:
+            # Values of different types never match, as in MongoDB
+            continue
+    return False
+
+
+TYPE_NAMES = {"string": str, "date": datetime, "array": list, "object": dict, "bool": bool, "int": int, "double": float}
+
+
+def _match_condition(values: list, condition) -> bool:
+    if not (isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)):
+        # A null condition also matches the missing fields
+        return condition in values or (condition is None and not values)
+
+    for operator, argument in condition.items():
+        if operator == "$eq":
+            matched = argument in values
+        elif operator == "$ne":
+            matched = argument not in values
+        elif operator == "$in":
+            matched = any(value in argument for value in values)
+        elif operator == "$nin":
+            matched = not any(value in argument for value in values)
+        elif operator in ["$gt", "$gte", "$lt", "$lte"]:
+            matched = _compare(values, operator, argument)
+        elif operator == "$exists":
+            matched = bool(values) == bool(argument)
+        elif operator == "$type":
+            if argument not in TYPE_NAMES:
+                raise StorageError(f"Unsupported type {argument}")
+            matched = any(isinstance(value, TYPE_NAMES[argument]) for value in values)
+        else:
+            raise StorageError(f"Unsupported query operator {operator}")
+        if not matched:
+            return False
+    return True
+
+
+def matches(document: dict, query: dict) -> bool:
+    """Whether the document satisfies a MongoDB filter"""
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            matched = all(matches(document, sub_query) for sub_query in condition)
+        elif key == "$or":
+            matched = any(matches(document, sub_query) for sub_query in condition)
+        elif key.startswith("$"):
+            raise StorageError(f"Unsupported query operator {key}")
+        else:
+            matched = _match_condition(_values(document, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def _copy_path(source: dict, target: dict, parts: list):
+    if parts[0] not in source:
+        return
+    value = source[parts[0]]
+    if len(parts) == 1:
+        target[parts[0]] = _clone(value)
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(parts[0], {}), parts[1:])
+    elif isinstance(value, list):
+        projected = target.setdefault(parts[0], [{} for _ in value])
+        for item, projected_item in zip(value, projected):
+            if isinstance(item, dict):
+                _copy_path(item, projected_item, parts[1:])
+
+
+def project(document: dict, projection: dict = None) -> dict:
+    """Applies an inclusion or exclusion projection to a copy of the document"""
+    projection = {key: value for key, value in (projection or {}).items() if key != "_id"}
+    included = [key for key, value in projection.items() if value]
+    if not included:
+        document = _clone(document)
+        for key in projection:
+            document.pop(key, None)
+        return document
+    result = {}
+    for path in included:
+        _copy_path(document, result, path.split("."))
+    return result
+
+
+def _parent(document: dict, path: str, create: bool = True):
+    """Returns the document holding the last part of the path and that part"""
+    parts = path.split(".")
+    for part in parts[:-1]:
+        if not isinstance(document.get(part), dict):
+            if not create:
+                return None, parts[-1]
+            document[part] = {}
+        document = document[part]
+    return document, parts[-1]
+
+
+def apply_update(document: dict, update, inserting: bool = False) -> bool:
+    """Applies the update operators to the document in place. Returns whether it changed."""
+    if isinstance(update, list):
+        raise StorageError("Aggregation pipeline updates are only supported by MongoDB")
+    before = _clone(document)
+    for operator, fields in update.items():
+        for path, argument in fields.items():
+            if operator == "$set" or operator == "$setOnInsert" and inserting:
+                parent, key = _parent(document, path)
+                parent[key] = _clone(argument)
+            elif operator == "$setOnInsert":
+                continue
+            elif operator == "$unset":
+                parent, key = _parent(document, path, create=False)
+                if parent is not None:
+                    parent.pop(key, None)
+            elif operator == "$addToSet":
+                parent, key = _parent(document, path)
+                items = argument["$each"] if isinstance(argument, dict) and "$each" in argument else [argument]
+                current = parent.setdefault(key, [])
+                for item in items:
+                    if item not in current:
+                        current.append(_clone(item))
+            elif operator == "$pull":
+                parent, key = _parent(document, path, create=False)
+                if parent is not None and isinstance(parent.get(key), list):
+                    parent[key] = [item for item in parent[key] if not _match_condition([item], argument)]
+            else:
+                raise StorageError(f"Unsupported update operator {operator}")
+    return document != before
+
+
+def _upsert_document(query: dict, update) -> dict:
+    """New document of an upsert, made of the equality conditions of the filter and the update"""
+    document = {}
+    for path, condition in query.items():
+        is_operator = isinstance(condition, dict) and any(key.startswith("$") for key in condition)
+        if not path.startswith("$") and not is_operator:
+            parent, key = _parent(document, path)
+            parent[key] = _clone(condition)
+    apply_update(document, update, inserting=True)
+    return document
+
+
+def _index_fields(keys) -> list:
+    return [keys] if isinstance(keys, str) else [field for field, _ in keys]
+
+
+### Collections
+class Cursor:
+    """Lazy result of find, supporting the sort, limit and batch_size calls of the registry"""
+    def __init__(self, collection: "DocumentCollection", query: dict, projection: dict):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_key = None
+        self.direction = 1
+        self.limit_count = 0
+
+    def sort(self, key: str, direction: int = 1):
+        self.sort_key, self.direction = key, direction
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        documents = self.collection._find(self.query)
+        if self.sort_key:
+            # Missing values first, like MongoDB, and without comparing values of different types
+            documents.sort(key=lambda document: (
+                (0, "") if not _values(document, self.sort_key) else (1, _values(document, self.sort_key)[0])
+            ), reverse=self.direction < 0)
+        if self.limit_count:
+            documents = documents[:self.limit_count]
+        return iter([project(document, self.projection) for document in documents])
+
+
+class DocumentCollection:
+    """
+    Collection API shared by the engines. Subclasses store the documents and implement
+    _scan, _insert, _replace and _delete, always called with the database lock held.
+    """
+    def __init__(self, name: str, lock: threading.RLock):
+        self.name = name
+        self.lock = lock
+        self.unique_fields = []
+        # (field, seconds) of the TTL indexes
+        self.expiring = []
+
+    ### Storage primitives
+    def _scan(self, lookup=None):
+        """
+        Yields (key, document) pairs, only those whose unique field has one of the values if lookup is given.
+        The documents must not be changed in place.
+        """
+        raise NotImplementedError
+
+    def _insert(self, document: dict):
+        raise NotImplementedError
+
+    def _replace(self, key, document: dict):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _create_index(self, fields: list, unique: bool):
+        pass
+
+    ### Helpers
+    def _lookup(self, query: dict):
+        """(field, values) of a unique field the query is restricted to, to avoid a full scan"""
+        for field in self.unique_fields:
+            condition = (query or {}).get(field)
+            if isinstance(condition, (int, str)):
+                return field, [condition]
+            if isinstance(condition, dict) and isinstance(condition.get("$in"), list) \
+                    and all(isinstance(value, (int, str)) for value in condition["$in"]):
+                # Repeated values would yield the same document twice
+                return field, list(dict.fromkeys(condition["$in"]))
+        return None
+
+    def _matching(self, query: dict) -> list:
+        return [(key, document) for key, document in self._scan(self._lookup(query)) if matches(document, query)]
+
+    def _find(self, query: dict) -> list:
+        with self.lock:
+            return [document for _, document in self._matching(query)]
+
+    def _expire(self):
+        for field, seconds in self.expiring:
+            # As in MongoDB, the expiring dates are in UTC
+            threshold = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=seconds)
+            for key, _ in self._matching({field: {"$lt": threshold}}):
+                self._delete(key)
+
+    def _check_unique(self, document: dict, key=None):
+        for field in self.unique_fields:
+            values = _values(document, field)
+            if values and any(other_key != key for other_key, _ in self._scan((field, values[:1]))):
+                raise DuplicateKeyError(f"Duplicate {field} {values[0]} in {self.name}")
+
+    def _update(self, query: dict, update, upsert: bool, many: bool) -> WriteResult:
+        with self.lock:
+            found = self._matching(query)
+            if not many:
+                found = found[:1]
+            if not found:
+                if not upsert:
+                    return WriteResult()
+                document = _upsert_document(query, update)
+                self._check_unique(document)
+                return WriteResult(upserted_id=self._insert(document))
+            modified = 0
+            for key, document in found:
+                document = _clone(document)
+                if apply_update(document, update):
+                    self._check_unique(document, key)
+                    self._replace(key, document)
+                    modified += 1
+            return WriteResult(matched_count=len(found), modified_count=modified)
+
+    ### Collection API
+    def create_index(self, keys, unique: bool = False, expireAfterSeconds: int = None, **kwargs) -> str:
+        fields = _index_fields(keys)
+        with self.lock:
+            if unique and len(fields) == 1 and fields[0] not in self.unique_fields:
+                self.unique_fields.append(fields[0])
+            if expireAfterSeconds is not None:
+                self.expiring = [(field, seconds) for field, seconds in self.expiring if field != fields[0]]
+                self.expiring.append((fields[0], expireAfterSeconds))
+            self._create_index(fields, unique)
+        return "_".join(f"{field}_1" for field in fields)
+
+    def find(self, filter: dict = None, projection: dict = None) -> Cursor:
+        return Cursor(self, filter or {}, projection)
+
+    def find_one(self, filter: dict = None, projection: dict = None):
+        return next(iter(self.find(filter, projection).limit(1)), None)
+
+    def distinct(self, key: str, filter: dict = None) -> list:
+        distinct = []
+        for document in self._find(filter or {}):
+            for value in _values(document, key):
+                if not isinstance(value, list) and value not in distinct:
+                    distinct.append(value)
+        return distinct
+
+    def count_documents(self, filter: dict) -> int:
+        return len(self._find(filter))
+
+    def insert_one(self, document: dict) -> WriteResult:
+        return self.insert_many([document])
+
+    def insert_many(self, documents: list, ordered: bool = True) -> WriteResult:
+        with self.lock:
+            self._expire()
+            keys = []
+            for document in documents:
+                document = _clone(document)
+                self._check_unique(document)
+                keys.append(self._insert(document))
+            return WriteResult(inserted_ids=keys)
+
+    def update_one(self, filter: dict, update, upsert: bool = False) -> WriteResult:
+        return self._update(filter, update, upsert, many=False)
+
+    def update_many(self, filter: dict, update, upsert: bool = False) -> WriteResult:
+        return self._update(filter, update, upsert, many=True)
+
+    def find_one_and_update(self, filter: dict, update, projection: dict = None, upsert: bool = False):
+        """Updates the first matching document and returns it as it was before the update"""
+        with self.lock:
+            found = self._matching(filter)[:1]
+            before = project(found[0][1], projection) if found else None
+            self._update(filter, update, upsert, many=False)
+            return before
+
+    def delete_one(self, filter: dict) -> WriteResult:
+        with self.lock:
+            found = self._matching(filter)[:1]
+            for key, _ in found:
+                self._delete(key)
+            return WriteResult(deleted_count=len(found))
+
+    def delete_many(self, filter: dict) -> WriteResult:
+        with self.lock:
+            found = self._matching(filter)
+            for key, _ in found:
+                self._delete(key)
+            return WriteResult(deleted_count=len(found))
+
+    def bulk_write(self, requests: list, ordered: bool = True) -> WriteResult:
+        """Applies UpdateOne, UpdateMany, DeleteOne, DeleteMany and InsertOne operations in order"""
+        with self.lock:
+            result = WriteResult()
+            for request in requests:
+                if isinstance(request, (UpdateOne, UpdateMany)):
+                    partial = self._update(request._filter, request._doc, request._upsert, many=isinstance(request, UpdateMany))
+                    result.matched_count += partial.matched_count
+                    result.modified_count += partial.modified_count
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    delete = self.delete_one if isinstance(request, DeleteOne) else self.delete_many
+                    result.deleted_count += delete(request._filter).deleted_count
+                elif isinstance(request, InsertOne):
+                    result.inserted_ids += self.insert_one(request._doc).inserted_ids
+                else:
+                    raise StorageError(f"Unsupported bulk operation {type(request).__name__}")
+            return result
+
+
+class MemoryCollection(DocumentCollection):
+    """Keeps the documents in a dictionary, with a hash index on each unique field"""
+    def __init__(self, name: str, lock: threading.RLock):
+        super().__init__(name, lock)
+        self.documents = {}
+        self.next_key = 0
+        # unique field -> value -> key
+        self.indexes = {}
+
+    def _index(self, key, document: dict, add: bool):
+        for field, index in self.indexes.items():
+            for value in _values(document, field)[:1]:
+                if add:
+                    index[value] = key
+                elif index.get(value) == key:
+                    del index[value]
+
+    def _create_index(self, fields: list, unique: bool):
+        if unique and len(fields) == 1 and fields[0] not in self.indexes:
+            self.indexes[fields[0]] = {}
+            for key, document in self.documents.items():
+                self._index(key, document, add=True)
+
+    def _scan(self, lookup=None):
+        if lookup and lookup[0] in self.indexes:
+            field, values = lookup
+            keys = [self.indexes[field][value] for value in values if value in self.indexes[field]]
+        else:
+            keys = list(self.documents)
+        # The stored documents themselves, the callers copy them before handing them out or changing them
+        for key in keys:
+            yield key, self.documents[key]
+
+    def _insert(self, document: dict):
+        self.next_key += 1
+        self.documents[self.next_key] = document
+        self._index(self.next_key, document, add=True)
+        return self.next_key
+
+    def _replace(self, key, document: dict):
+        self._index(key, self.documents[key], add=False)
+        self.documents[key] = document
+        self._index(key, document, add=True)
+
+    def _delete(self, key):
+        self._index(key, self.documents.pop(key), add=False)
+
+
+def _encode(document: dict) -> str:
+    def default(value):
+        if isinstance(value, datetime):
+            return {"$date": value.isoformat()}
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    return json.dumps(document, default=default)
+
+
+def _decode(text: str) -> dict:
+    def object_hook(value):
+        if len(value) == 1 and "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+        return value
+    return json.loads(text, object_hook=object_hook)
+
+
+class SQLiteCollection(DocumentCollection):
+    """Keeps each document as JSON in a row of its own table, unique fields are indexed by SQLite"""
+    def __init__(self, name: str, lock: threading.RLock, connection: sqlite3.Connection):
+        super().__init__(name, lock)
+        self.connection = connection
+        self.table = f'"collection_{name}"'
+        with self.lock:
+            self._execute(f"CREATE TABLE IF NOT EXISTS {self.table} (id INTEGER PRIMARY KEY AUTOINCREMENT, document TEXT NOT NULL)")
+
+    def _execute(self, statement: str, parameters: tuple = ()):
+        try:
+            with self.connection:
+                return self.connection.execute(statement, parameters)
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e)) from e
+        except sqlite3.Error as e:
+            raise StorageError(str(e)) from e
+
+    def _create_index(self, fields: list, unique: bool):
+        if unique and len(fields) == 1:
+            name = f'"{self.name}_{fields[0]}_unique"'
+            self._execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {self.table} (json_extract(document, '$.{fields[0]}'))")
+
+    def _scan(self, lookup=None):
+        if lookup:
+            field, values = lookup
+            placeholders = ", ".join("?" for _ in values)
+            rows = self._execute(
+                f"SELECT id, document FROM {self.table} WHERE json_extract(document, '$.{field}') IN ({placeholders})",
+                tuple(values)
+            ).fetchall()
+        else:
+            rows = self._execute(f"SELECT id, document FROM {self.table}").fetchall()
+        for key, text in rows:
+            yield key, _decode(text)
+
+    def _insert(self, document: dict):
+        return self._execute(f"INSERT INTO {self.table} (document) VALUES (?)", (_encode(document),)).lastrowid
+
+    def _replace(self, key, document: dict):
+        self._execute(f"UPDATE {self.table} SET document = ? WHERE id = ?", (_encode(document), key))
+
+    def _delete(self, key):
+        self._execute(f"DELETE FROM {self.table} WHERE id = ?", (key,))
+
+
+### Databases
+class MemoryDatabase:
+    """Collections kept in the process memory, lost on exit"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = MemoryCollection(name, self.lock)
+            return self.collections[name]
+
+
+class SQLiteDatabase:
+    """Collections stored in one SQLite file, shared by the threads through a single connection"""
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> SQLiteCollection:
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = SQLiteCollection(name, self.lock, self.connection)
+            return self.collections[name]
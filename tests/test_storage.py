@@ -0,0 +1,180 @@
+'''
+Pins the memory and SQLite engines to the MongoDB behaviour the registry relies on.
+Run from the repository root with python -m pytest.
+'''
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo import DeleteOne, InsertOne, UpdateMany, UpdateOne, errors
+
+from storage import MemoryDatabase, SQLiteDatabase
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def collection(request, tmp_path):
+    database = MemoryDatabase() if request.param == "memory" else SQLiteDatabase(str(tmp_path / "catalog.db"))
+    collection = database["devices"]
+    collection.create_index("deviceId", unique=True)
+    collection.insert_many([
+        {"deviceId": 1, "deviceStatus": "ON", "deviceLocation": {"plantId": 10},
+         "servicesDetails": [{"serviceType": "MQTT", "topic": ["a"]}, {"serviceType": "REST"}], "inventory": [1, 2]},
+        {"deviceId": 2, "deviceStatus": "OFF", "deviceLocation": {"plantId": 10}, "inventory": [2, 3]},
+        {"deviceId": 3, "deviceStatus": "ON", "deviceLocation": {"plantId": 20}, "name": "pump"},
+    ])
+    return collection
+
+
+def ids(documents) -> list:
+    return sorted(document["deviceId"] for document in documents)
+
+
+### Queries
+def test_repeated_in_values_match_each_document_once(collection):
+    query = {"deviceId": {"$in": [1, 1, 2]}}
+    assert ids(collection.find(query)) == [1, 2]
+    assert collection.count_documents(query) == 2
+    assert collection.update_many(query, {"$set": {"deviceStatus": "DISABLE"}}).matched_count == 2
+    assert collection.delete_many(query).deleted_count == 2
+    assert ids(collection.find()) == [3]
+
+
+def test_arrays_match_by_their_elements(collection):
+    assert ids(collection.find({"inventory": 2})) == [1, 2]
+    assert ids(collection.find({"inventory": {"$in": [3, 4]}})) == [2]
+    assert ids(collection.find({"servicesDetails.serviceType": "REST"})) == [1]
+    assert ids(collection.find({"servicesDetails.topic": "a"})) == [1]
+
+
+def test_missing_fields(collection):
+    assert ids(collection.find({"name": None})) == [1, 2]
+    assert ids(collection.find({"name": {"$ne": "pump"}})) == [1, 2]
+    assert ids(collection.find({"name": {"$exists": True}})) == [3]
+    assert ids(collection.find({"name": {"$nin": ["pump"]}})) == [1, 2]
+
+
+def test_comparisons_skip_other_types(collection):
+    assert ids(collection.find({"deviceStatus": {"$gt": 1}})) == []
+    assert ids(collection.find({"deviceLocation.plantId": {"$gte": 10, "$lt": 20}})) == [1, 2]
+    assert ids(collection.find({"$or": [{"deviceId": 1}, {"name": "pump"}], "deviceStatus": "ON"})) == [1, 3]
+
+
+def test_unsupported_operators_raise_pymongo_errors(collection):
+    # Not implemented by the engines, they fail like a database error instead of ignoring the condition
+    with pytest.raises(errors.PyMongoError):
+        collection.count_documents({"deviceId": {"$regex": "1"}})
+    with pytest.raises(errors.PyMongoError):
+        collection.update_one({"deviceId": 1}, [{"$set": {"deviceStatus": "ON"}}])
+
+
+### Reads
+def test_projection(collection):
+    assert collection.find_one({"deviceId": 1}, {"_id": 0, "deviceLocation.plantId": 1}) == {"deviceLocation": {"plantId": 10}}
+    assert collection.find_one({"deviceId": 1}, {"_id": 0, "servicesDetails.serviceType": 1}) == \
+        {"servicesDetails": [{"serviceType": "MQTT"}, {"serviceType": "REST"}]}
+    assert set(collection.find_one({"deviceId": 3}, {"_id": 0, "inventory": 0, "servicesDetails": 0})) == \
+        {"deviceId", "deviceStatus", "deviceLocation", "name"}
+
+
+def test_returned_documents_are_copies(collection):
+    document = collection.find_one({"deviceId": 1})
+    document["deviceLocation"]["plantId"] = 99
+    document["inventory"].append(9)
+    assert collection.find_one({"deviceId": 1}, {"_id": 0, "deviceLocation": 1, "inventory": 1}) == \
+        {"deviceLocation": {"plantId": 10}, "inventory": [1, 2]}
+
+
+def test_sort_puts_missing_values_first(collection):
+    assert [document["deviceId"] for document in collection.find().sort("name", 1)][-1] == 3
+    assert [document["deviceId"] for document in collection.find().sort("deviceId", -1).limit(2)] == [3, 2]
+
+
+def test_distinct_unwinds_arrays(collection):
+    assert sorted(collection.distinct("inventory")) == [1, 2, 3]
+    assert sorted(collection.distinct("deviceId", {"deviceStatus": "ON"})) == [1, 3]
+
+
+def test_dates_round_trip(collection):
+    now = datetime.now().replace(microsecond=0)
+    collection.update_one({"deviceId": 1}, {"$set": {"lastUpdated": now}})
+    assert collection.find_one({"deviceId": 1})["lastUpdated"] == now
+    assert ids(collection.find({"lastUpdated": {"$gte": now - timedelta(seconds=1)}})) == [1]
+
+
+### Writes
+def test_update_operators(collection):
+    collection.update_one({"deviceId": 1}, {
+        "$set": {"deviceLocation.room": "kitchen"},
+        "$unset": {"servicesDetails": ""},
+        "$addToSet": {"inventory": {"$each": [2, 4]}},
+    })
+    collection.update_one({"deviceId": 2}, {"$pull": {"inventory": {"$in": [2]}}})
+    assert collection.find_one({"deviceId": 1}, {"_id": 0, "deviceLocation": 1, "servicesDetails": 1, "inventory": 1}) == \
+        {"deviceLocation": {"plantId": 10, "room": "kitchen"}, "inventory": [1, 2, 4]}
+    assert collection.find_one({"deviceId": 2})["inventory"] == [3]
+
+
+def test_matched_and_modified_counts(collection):
+    result = collection.update_many({"deviceLocation.plantId": 10}, {"$set": {"deviceStatus": "ON"}})
+    assert (result.matched_count, result.modified_count) == (2, 1)
+    result = collection.update_one({"deviceId": 9}, {"$set": {"deviceStatus": "ON"}})
+    assert (result.matched_count, result.modified_count, result.upserted_id) == (0, 0, None)
+
+
+def test_upsert_builds_the_document_from_the_equality_conditions(collection):
+    result = collection.update_one(
+        {"deviceId": 4, "deviceStatus": {"$ne": "OFF"}},
+        {"$set": {"deviceStatus": "ON"}, "$setOnInsert": {"name": "new"}},
+        upsert=True
+    )
+    assert result.upserted_id is not None
+    assert collection.find_one({"deviceId": 4}, {"_id": 0}) == {"deviceId": 4, "deviceStatus": "ON", "name": "new"}
+    collection.update_one({"deviceId": 4}, {"$setOnInsert": {"name": "other"}}, upsert=True)
+    assert collection.find_one({"deviceId": 4})["name"] == "new"
+
+
+def test_find_one_and_update_returns_the_document_before_the_update(collection):
+    before = collection.find_one_and_update(
+        {"deviceId": 1}, {"$addToSet": {"inventory": 5}}, projection={"_id": 0, "inventory": 1}
+    )
+    assert before == {"inventory": [1, 2]}
+    assert collection.find_one({"deviceId": 1})["inventory"] == [1, 2, 5]
+    assert collection.find_one_and_update({"deviceId": 9}, {"$set": {"name": "x"}}, upsert=True) is None
+    assert collection.count_documents({"deviceId": 9}) == 1
+
+
+def test_unique_index(collection):
+    with pytest.raises(errors.DuplicateKeyError):
+        collection.insert_one({"deviceId": 1})
+    with pytest.raises(errors.DuplicateKeyError):
+        collection.update_one({"deviceId": 2}, {"$set": {"deviceId": 3}})
+    with pytest.raises(errors.DuplicateKeyError):
+        collection.update_one({"name": "missing"}, {"$set": {"deviceId": 1}}, upsert=True)
+    assert collection.count_documents({}) == 3
+
+
+def test_delete(collection):
+    assert collection.delete_one({"deviceLocation.plantId": 10}).deleted_count == 1
+    assert collection.delete_many({"deviceId": {"$in": [1, 2, 3, 4]}}).deleted_count == 2
+    assert collection.count_documents({}) == 0
+
+
+def test_bulk_write(collection):
+    result = collection.bulk_write([
+        InsertOne({"deviceId": 4}),
+        UpdateOne({"deviceId": 1}, {"$set": {"deviceStatus": "OFF"}}),
+        UpdateMany({"deviceLocation.plantId": 10}, {"$set": {"name": "sensor"}}),
+        UpdateOne({"deviceId": 5}, {"$set": {"name": "new"}}, upsert=True),
+        DeleteOne({"deviceId": 3}),
+    ], ordered=False)
+    assert (result.matched_count, result.modified_count, result.deleted_count) == (3, 3, 1)
+    assert ids(collection.find()) == [1, 2, 4, 5]
+
+
+def test_ttl_index_expires_utc_dates(collection):
+    tombstones = collection
+    tombstones.create_index("deletedAt", expireAfterSeconds=60)
+    utc_now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    tombstones.insert_many([{"deviceId": 7, "deletedAt": utc_now - timedelta(minutes=2)}, {"deviceId": 8, "deletedAt": utc_now}])
+    # MongoDB's TTL monitor removes the expired entries within a minute, the engines before the next insert
+    tombstones.insert_one({"deviceId": 9})
+    assert ids(tombstones.find({"deletedAt": {"$exists": True}})) == [8]
@@ -19,8 +19,7 @@ class Adaptor():
         self.available_measure_types = self.config.AVAILABLE_MEASURE_TYPES
         print("Initiating the adaptor...")
 
-        self.set_broker()
-        self.set_main_topic()
+        self.bootstrap()
         self.initiate_mqtt()
         self.subscribe_to_topic()
         self.check_and_create_channel()
@@ -93,15 +92,18 @@ class Adaptor():
 
 
 
-    def set_broker(self, retries=3, delay=5):
+    def bootstrap(self, retries=3, delay=5):
         for attempt in range(retries):
             try:
-                req_b = requests.get(self.config.CATALOG_URL + "/broker")
+                # Broker and main topic come together in a single request
+                req_b = requests.get(self.config.CATALOG_URL + "/bootstrap")
                 req_b.raise_for_status()  # Raise an exception for HTTP errors
                 req_data = req_b.json()
-                broker_info = req_data.get("content", {})
+                bootstrap = req_data.get("content", {})
+                broker_info = bootstrap.get("broker") or {}
                 self.broker, self.port = broker_info.get("IP"), int(broker_info.get("port", 1883))
-                print("Broker's info received")
+                self.main_topic = bootstrap.get("mainTopic")
+                print("Broker's info and main topic received")
                 return {"success": True}
                 # Exit the function if successful
 
@@ -115,11 +117,6 @@ class Adaptor():
                     raise ConnectionError("All attempts to get the broker's information have failed.")
 
 
-    def set_main_topic(self):
-        req = requests.get(self.config.CATALOG_URL + "/main_topic")
-        self.main_topic = req.json().get("content", {})
-
-
     def initiate_mqtt(self):
         self.mqtt_client = MyMQTT(clientID = self.config.MQTT_CLIENT_ID,
                                 broker=self.broker,
@@ -132,18 +129,13 @@ class Adaptor():
     def _get_devices(self, plant_id: int):
         try: 
             url = f"{self.catalog_address}/{self.config.DEVICES_ENDPOINT}"
-            response = requests.get(url)
+            # The catalog filters the devices by plant_id
+            response = requests.get(url, params={"plantId": plant_id})
             response.raise_for_status()
             devices_response = response.json()
             
             if devices_response.get("success"):
-                devices_list = devices_response["content"]
-                # Filter devices by plant_id
-                filtered_devices = [
-                    device for device in devices_list 
-                    if device.get("deviceLocation", {}).get("plantId") == plant_id
-                ]
-                return filtered_devices
+                return devices_response["content"]
             return []
             
         except requests.RequestException as e:
@@ -1,4 +1,15 @@
 '''Utility functions across the scripts'''
+import hashlib
+import json
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    # Optional, the standard library encoder is used without it
+    orjson = None
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 def to_camel_case(snake_str) -> str:
     return "".join(word.capitalize() for word in snake_str.lower().split("_"))
@@ -14,6 +25,30 @@ def convert_to_bool(param):
     if param and param.lower() in ["true", "1"]:
         return bool(param)
 
+def json_default(value):
+    """Serializes the datetimes stored in the database using the catalog's time format"""
+    if isinstance(value, datetime):
+        return value.strftime(TIME_FORMAT)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _stdlib_dumps(value) -> bytes:
+    return json.dumps(value, default=json_default).encode("utf-8")
+
+def _orjson_dumps(value) -> bytes:
+    # Datetimes are passed to json_default to keep the catalog's time format instead of ISO 8601
+    return orjson.dumps(value, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+
+def json_serializer(name: str = "orjson"):
+    """Returns the function encoding a value to JSON bytes, falling back to the standard library if orjson is missing"""
+    if name == "orjson" and orjson is not None:
+        return _orjson_dumps
+    return _stdlib_dumps
+
+def content_hash(data: dict) -> str:
+    """Hash of a payload's content, ignoring its lastUpdated and lastModified timestamps"""
+    content = {key: value for key, value in data.items() if key not in ["lastUpdated", "last_updated", "lastModified", "last_modified"]}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
 def response_creator(success: bool, content: dict = None, message: str = "", status: int = 200) -> dict:
     response = {
         "success": success,
@@ -24,3 +59,36 @@ def response_creator(success: bool, content: dict = None, message: str = "", sta
     if message:
         response["message"] = message
     return response
+
+
+if __name__ == "__main__":
+    ### micro-benchmark of the encoding and compression of a /devices response
+    def bench_devices_response(n: int = 10000, rounds: int = 20):
+        import gzip, time, zlib
+
+        devices = [{
+            "deviceId": 10000 + i, "deviceType": "sensor", "deviceName": f"sensor_{i}",
+            "deviceStatus": "ON", "statusOptions": ["DISABLE", "ON"], "deviceLocation": {"plantId": 100 + i // 10},
+            "measureTypes": ["temperature", "humidity"], "availableServices": ["MQTT"],
+            "servicesDetails": [{"serviceType": "MQTT", "topic": [f"greenhouse/sensors/{100 + i // 10}/temperature"]}],
+            "lastUpdated": datetime(2025, 1, 1, 12, 0, 0),
+        } for i in range(n)]
+        response = response_creator(True, content=devices, status=200)
+
+        for name in ["json", "orjson"] if orjson else ["json"]:
+            dumps = json_serializer(name)
+            start = time.process_time()
+            for _ in range(rounds):
+                body = dumps(response)
+            elapsed = time.process_time() - start
+            print(f"{name} encoding: {elapsed / rounds * 1000:.2f} ms CPU per response, {len(body)} bytes")
+
+        for name, compress in [("gzip", lambda data: gzip.compress(data, 5)), ("deflate", lambda data: zlib.compress(data, 5))]:
+            start = time.process_time()
+            for _ in range(rounds):
+                compressed = compress(body)
+            elapsed = time.process_time() - start
+            print(f"{name} level 5: {elapsed / rounds * 1000:.2f} ms CPU per response, {len(compressed)} bytes "
+                  f"({len(compressed) / len(body):.1%} of the JSON)")
+
+    bench_devices_response()